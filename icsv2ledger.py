@@ -6,20 +6,38 @@
 # Requires Python >= 3.2 and Ledger >= 3.0
 
 import argparse
+import collections
 import csv
 import io
+import json
+import itertools
 import glob
-import mmap
 import sys
 import os
 import hashlib
 import re
+import shlex
+import shutil
+import socket
+import socketserver
+import string
 import subprocess
+import tempfile
+import threading
+import time
 import readline
+import concurrent.futures
 import configparser
+import contextlib
+import cProfile
+import functools
+import importlib
+import importlib.util
+import pstats
+import tracemalloc
 from argparse import HelpFormatter
 from dataclasses import dataclass
-from datetime import datetime
+from datetime import date, datetime
 from operator import attrgetter
 from locale   import atof
 from typing import AnyStr, Pattern, Optional
@@ -112,6 +130,26 @@ DEFAULTS = dotdict({
     'csv_decimal_comma': False,
     'ledger_decimal_comma': False,
     'skip_older_than': str(-1),
+    'date_sorted': False,
+    'cache_dir': '',
+    'native_scanner': False,
+    'output_buffer_size': str(1 << 20),
+    'flush_interval': str(0),
+    'atomic': False,
+    'mapping_flush_interval': str(0),
+    'compact_mappings': False,
+    'output_dir': '',
+    'jobs': str(1),
+    'input_files': '',
+    'stats': False,
+    'stats_file': '',
+    'mapping_report': False,
+    'mapping_report_file': '',
+    'profile': '',
+    'trace_memory': '',
+    'serve': '',
+    'client': '',
+    'unattended': False,
     'prompt_add_mappings': False,
     'entry_review': False})
 
@@ -145,6 +183,23 @@ DEFAULT_TEMPLATE = """\
     {tags}
 """
 
+TEMPLATE_FIELDS = frozenset([
+    'date', 'effective_date', 'cleared_character', 'payee',
+    'transaction_index', 'uuid', 'debit_account', 'debit_currency', 'debit',
+    'credit_account', 'credit_currency', 'credit', 'tags', 'md5sum', 'csv'])
+
+UUID_REGEX = re.compile(r"UUID:", re.IGNORECASE)
+
+# Line breaks within a quoted CSV field, with the spaces around them
+NEWLINE_REGEX = re.compile(r"\s*(?:\r\n|\r|\n)\s*")
+
+_DEFAULT_REGEX_FLAGS = re.compile('').flags
+
+# Characters to drop from amounts, by csv_decimal_comma
+_NON_NUMBER_REGEXES = {
+    False: re.compile(r'[^-0-9.]'),
+    True: re.compile(r'[^-0-9,]')}
+
 
 def find_first_file(arg_file, alternatives):
     """Because of http://stackoverflow.com/questions/12397681,
@@ -178,11 +233,19 @@ def decode_escape_sequences(string):
                   string),
 
 
-def parse_args_and_config_file():
+# Options taken from the command line of --client, the others being the
+# ones of the server
+CLIENT_OPTIONS = ('client', 'encoding', 'incremental', 'infile', 'outfile')
+
+
+def parse_args_and_config_file(account=None, config_file=None):
     """ Read options from config file and CLI args
     1. Reads hard coded DEFAULTS
     2. Supersedes by values in config file
     3. Supersedes by values from CLI args
+
+    account and config_file replace --account and --config-file, for runs
+    of several sections.
     """
 
     # Build preparser with only config-file and account
@@ -200,15 +263,27 @@ def parse_args_and_config_file():
         help=('configuration file'
               ' (default search order: {0})'
               .format(', '.join(FILE_DEFAULTS.config_file))))
+    preparser.add_argument(
+        '--sections',
+        metavar='NAME',
+        nargs='*',
+        help=('convert the input_files of each named config file section,'
+              ' or of all sections with input_files if none is named'))
 
     # Parse args with preparser, and find config file
     args, remaining_argv = preparser.parse_known_args()
+    if account is not None:
+        args.account = account
+    if config_file is not None:
+        args.config_file = config_file
     args.config_file = find_first_file(args.config_file,
                                        FILE_DEFAULTS.config_file)
 
     # Initialize configparser with DEFAULTS, and then read config file
-    if args.config_file and ('-h' not in remaining_argv and
-                             '--help' not in remaining_argv):
+    if (args.config_file and
+            (args.sections is None or account is not None) and
+            ('-h' not in remaining_argv and
+             '--help' not in remaining_argv)):
         config = configparser.RawConfigParser(DEFAULTS)
         config.read(args.config_file)
         if not config.has_section(args.account):
@@ -258,6 +333,24 @@ def parse_args_and_config_file():
         default=sys.stdout,
         help=('output filename or stdout in Ledger syntax'
               ' (default: {0})'.format('stdout')))
+    parser.add_argument(
+        '--batch',
+        metavar='GLOB',
+        nargs='+',
+        help=('convert each CSV file matching the patterns to a ledger file'
+              ' of the same name, instead of infile to outfile'))
+    parser.add_argument(
+        '--output-dir',
+        metavar='DIR',
+        help=('directory of the ledger files written by --batch, instead of'
+              ' the directory of each CSV file'))
+    parser.add_argument(
+        '--jobs',
+        metavar='INT',
+        type=int,
+        help=('number of processes converting entries with --quiet,'
+              ' 0 for one per CPU'
+              ' (default: {0})'.format(DEFAULTS.jobs)))
     parser.add_argument(
         '--encoding',
         metavar='STR',
@@ -275,6 +368,17 @@ def parse_args_and_config_file():
         help=('ledger file where to read payees/accounts'
               ' (default search order: {0})'
               .format(', '.join(FILE_DEFAULTS.ledger_file))))
+    parser.add_argument(
+        '--cache-dir',
+        metavar='DIR',
+        help=('directory where to cache what is read from ledger files'
+              ' (default: no cache)'))
+    parser.add_argument(
+        '--native-scanner',
+        action='store_true',
+        help=('read payees/accounts from the ledger file directly'
+              ' instead of running ledger'
+              ' (default: {0})'.format(DEFAULTS.native_scanner)))
     parser.add_argument(
         '--quiet', '-q',
         action='store_true',
@@ -311,6 +415,12 @@ def parse_args_and_config_file():
         action='store_true',
         help=('append output as transactions are processed'
               ' (default: {0})'.format(DEFAULTS.incremental)))
+    parser.add_argument(
+        '--atomic',
+        action='store_true',
+        help=('write output to a temporary file renamed over outfile at'
+              ' the end, instead of truncating outfile first'
+              ' (default: {0})'.format(DEFAULTS.atomic)))
     parser.add_argument(
         '--reverse',
         action='store_true',
@@ -387,6 +497,31 @@ def parse_args_and_config_file():
         help=('file which holds the mappings'
               ' (default search order: {0})'
               .format(', '.join(FILE_DEFAULTS.mapping_file))))
+    parser.add_argument(
+        '--mapping-flush-interval',
+        metavar='SECONDS',
+        type=float,
+        help=('time after which new mappings are written to the mapping'
+              ' file, checked as they are added and written before'
+              ' prompts, 0 to write them at once'
+              ' (default: {0})'.format(DEFAULTS.mapping_flush_interval)))
+    parser.add_argument(
+        '--mapping-report',
+        action='store_true',
+        help=('print the mappings which never won an entry to stderr at'
+              ' the end, slowing down matching'
+              ' (default: {0})'.format(DEFAULTS.mapping_report)))
+    parser.add_argument(
+        '--mapping-report-file',
+        metavar='FILE',
+        help=('write the counters of all mappings of --mapping-report to'
+              ' FILE as JSON instead'))
+    parser.add_argument(
+        '--compact-mappings',
+        action='store_true',
+        help=('remove mappings superseded by a later one for the same'
+              ' pattern from the mapping file at the end'
+              ' (default: {0})'.format(DEFAULTS.compact_mappings)))
     parser.add_argument(
         '--template-file',
         metavar='FILE',
@@ -415,6 +550,23 @@ def parse_args_and_config_file():
         help=('delimiter between fields in the csv'
               ' (default: {0})'.format(DEFAULTS.delimiter)))
 
+    parser.add_argument(
+        '--output-buffer-size',
+        metavar='INT',
+        type=int,
+        help=('number of characters buffered before writing the output'
+              ' file with --quiet and without --incremental'
+              ' (default: {0})'.format(DEFAULTS.output_buffer_size)))
+
+    parser.add_argument(
+        '--flush-interval',
+        metavar='SECONDS',
+        type=float,
+        help=('time after which buffered output is written, checked as'
+              ' transactions are written and written before prompts, 0 to'
+              ' wait for a full buffer'
+              ' (default: {0})'.format(DEFAULTS.flush_interval)))
+
     parser.add_argument(
         '--skip-older-than',
         metavar='INT',
@@ -422,6 +574,66 @@ def parse_args_and_config_file():
         help=('skip entries more than X days old (-1 indicates keep all)'
               ' (default: {0})'.format(DEFAULTS.skip_older_than)))
 
+    parser.add_argument(
+        '--date-sorted',
+        action='store_true',
+        help=('CSV entries are sorted by date, stop reading once older'
+              ' than --skip-older-than'
+              ' (default: {0})'.format(DEFAULTS.date_sorted)))
+
+    parser.add_argument(
+        '--stats',
+        action='store_true',
+        help=('print the time spent in each phase, and counts of rows and'
+              ' mappings, to stderr at the end'
+              ' (default: {0})'.format(DEFAULTS.stats)))
+
+    parser.add_argument(
+        '--stats-file',
+        metavar='FILE',
+        help='write the report of --stats to FILE as JSON instead')
+
+    parser.add_argument(
+        '--profile',
+        metavar='FILE',
+        help=('profile the run with cProfile, writing the statistics to'
+              ' FILE, or the slowest functions to stderr for -'))
+
+    parser.add_argument(
+        '--trace-memory',
+        metavar='FILE',
+        help=('trace memory allocations with tracemalloc, writing the'
+              ' largest ones to FILE, or to stderr for -'))
+
+    parser.add_argument(
+        '--stage-hook',
+        metavar='MODULE:FUNCTION',
+        action='append',
+        help=('call FUNCTION(stage, seconds) at the end of each stage of'
+              ' the conversion, MODULE being a module name or a python'
+              ' file'))
+
+    parser.add_argument(
+        '--serve',
+        metavar='SOCKET',
+        help=('keep the journal, mappings and accounts in memory and'
+              ' convert the CSV sent by --client on the unix socket SOCKET,'
+              ' reading again only the files which changed'))
+
+    parser.add_argument(
+        '--client',
+        metavar='SOCKET',
+        help=('convert infile with the server listening on the unix'
+              ' socket SOCKET, instead of reading the files in this'
+              ' process'))
+
+    parser.add_argument(
+        '--unattended',
+        action='store_true',
+        help=('never ask for payee and account: unmapped entries get the'
+              ' default expense account, and no mapping is added'
+              ' (default: {0})'.format(DEFAULTS.unattended)))
+
     parser.add_argument(
         '--prompt-add-mappings',
         action='store_true',
@@ -434,7 +646,13 @@ def parse_args_and_config_file():
         help=('displays transaction summary and request confirmation before committing to ledger'
               ' (default: {0})'.format(DEFAULTS.entry_review)))
 
+    preargs = args
     args = parser.parse_args(remaining_argv)
+    args.config_file = preargs.config_file
+    # sections are only run from the options of no particular section
+    args.sections = preargs.sections if account is None else None
+    # the section which --account names, sent by --client to the server
+    args.section = preargs.account
 
     args.ledger_file = find_first_file(
         args.ledger_file, FILE_DEFAULTS.ledger_file)
@@ -462,7 +680,51 @@ def parse_args_and_config_file():
               file=sys.stderr)
         sys.exit(1)
 
-    if args.encoding.lower() != args.infile.encoding.lower():
+    if args.atomic and (args.incremental or args.outfile is sys.stdout):
+        print('atomic can not be used with incremental'
+              ' or when writing to stdout.',
+              file=sys.stderr)
+        sys.exit(1)
+
+    if ((args.batch or args.sections is not None or args.serve) and
+            (args.infile is not sys.stdin or args.outfile is not sys.stdout)):
+        print('batch, sections and serve can not be used with infile'
+              ' or outfile.',
+              file=sys.stderr)
+        sys.exit(1)
+
+    if ((args.serve or args.client) and
+            (args.batch or args.sections is not None or
+             (args.serve and args.client))):
+        print('serve and client can not be used together, or with batch'
+              ' or sections.',
+              file=sys.stderr)
+        sys.exit(1)
+
+    if args.client:
+        # The server converts with its own options, or those of the
+        # section given by --account: find the options given on command
+        # line, and only accept those of the client itself
+        unset = object()
+        given = argparse.Namespace(**dict.fromkeys(vars(args), unset))
+        given.stage_hook = None  # appended to
+        given = vars(parser.parse_args(remaining_argv, given))
+        for name in ('infile', 'outfile'):
+            if given[name] not in (unset, sys.stdin, sys.stdout):
+                given[name].close()
+        ignored = sorted(name for name, value in given.items()
+                         if value is not unset and value is not None and
+                         name not in CLIENT_OPTIONS)
+        if ignored:
+            print('{0} can not be used with client, the server converts'
+                  ' with its own options.'
+                  .format(', '.join('--' + name.replace('_', '-')
+                                    for name in ignored)),
+                  file=sys.stderr)
+            sys.exit(1)
+
+    if (not args.batch and args.sections is None and
+            args.encoding.lower() != args.infile.encoding.lower()):
         args.infile = io.TextIOWrapper(args.infile.detach(),
                                        encoding=args.encoding)
 
@@ -482,57 +744,208 @@ class MappingInfo:
     transfer_to_file: Optional[str]
 
 
+class TransactionTemplate:
+    """
+    This represents the template used to render ledger transactions.
+    It is parsed and validated once, and then shared by all entries.
+    """
+
+    _CONVERSIONS = {'r': repr, 's': str, 'a': ascii}
+
+    def __init__(self, template, addons=()):
+        """Parameters:
+        template: str.format template of one transaction
+        addons: names of the addon fields available to the template
+        Raise ValueError if the template is malformed or uses an unknown
+        field.
+        """
+        self.template = template
+        known_fields = TEMPLATE_FIELDS.union(addons)
+        fields = set()
+        # Parsed template as (literal, field, format_spec, conversion)
+        # tuples, or None when rendering must go through str.format
+        parts = []
+        for literal, field, format_spec, conversion in string.Formatter().parse(template):
+            if field is None:
+                if parts is not None:
+                    parts.append((literal, None, None, None))
+                continue
+            nested = [f for _, f, _, _ in string.Formatter().parse(format_spec)
+                      if f is not None]
+            for f in [field] + nested:
+                name = re.match(r'[^.\[]*', f).group()
+                if name not in known_fields:
+                    raise ValueError('unknown field {{{0}}}'.format(f))
+                fields.add(name)
+            if parts is None:
+                continue
+            if nested or not field.isidentifier():
+                # attribute, index or nested field: leave it to str.format
+                parts = None
+            else:
+                parts.append((literal, field, format_spec,
+                              self._CONVERSIONS.get(conversion)))
+        self.fields = frozenset(fields)
+        self._parts = parts
+
+    @classmethod
+    def from_file(cls, template_file, addons=()):
+        """Load template_file, or DEFAULT_TEMPLATE when there is none."""
+        template = ""
+        if template_file:
+            with open(template_file, 'r', encoding='utf-8') as f:
+                template = f.read()
+        return cls(template if template else DEFAULT_TEMPLATE, addons)
+
+    def render(self, format_data):
+        """Return the transaction for format_data, without blank lines or
+        trailing spaces.
+        """
+        if self._parts is None:
+            output = self.template.format(**format_data)
+        else:
+            chunks = []
+            for literal, field, format_spec, conversion in self._parts:
+                chunks.append(literal)
+                if field is not None:
+                    value = format_data[field]
+                    if conversion is not None:
+                        value = conversion(value)
+                    chunks.append(format(value, format_spec))
+            output = ''.join(chunks)
+        output_lines = output.split('\n')
+        return '\n'.join([x.rstrip() for x in output_lines if x.strip()]) + '\n'
+
+
+class ColumnPlan:
+    """
+    This represents where the values of an Entry are found in the fields
+    of a CSV row, resolved once from the options.
+    """
+
+    def __init__(self, options):
+        self.date = options.date - 1
+        if options.effective_date:
+            self.effective_date = options.effective_date - 1
+        else:
+            self.effective_date = None
+        self.desc = [int(index) - 1
+                     for index in re.split(r',\s*', options.desc)]
+        if 'addons' in options:
+            self.addons = [(k, v - 1) for k, v in options.addons.items()]
+        else:
+            self.addons = []
+        self.credit = amount_parser(options.credit,
+                                    options.csv_decimal_comma,
+                                    options.ledger_decimal_comma)
+        self.debit = amount_parser(options.debit,
+                                   options.csv_decimal_comma,
+                                   options.ledger_decimal_comma)
+        self.dates = DateConverter(options.csv_date_format,
+                                   options.ledger_date_format)
+
+
+class DateConverter:
+    """
+    Converts dates of the CSV file into ledger dates. Conversions are
+    cached, as exports repeat the same dates over many lines.
+    """
+
+    CACHE_SIZE = 4096
+
+    def __init__(self, csv_date_format, ledger_date_format, today=None):
+        self.csv_date_format = csv_date_format
+        self.reformat = bool(ledger_date_format and
+                             ledger_date_format != csv_date_format)
+        self.ledger_date_format = ledger_date_format
+        # Computed once, so entries are aged against the same day
+        self.today = (today or date.today()).toordinal()
+        self.convert = functools.lru_cache(self.CACHE_SIZE)(self._convert)
+
+    def _convert(self, csv_date):
+        """Return (datetime, ledger formatted date, day ordinal) of
+        csv_date.
+        """
+        parsed = datetime.strptime(csv_date, self.csv_date_format)
+        if self.reformat:
+            ledger_date = parsed.strftime(self.ledger_date_format)
+        else:
+            ledger_date = csv_date
+        return parsed, ledger_date, parsed.toordinal()
+
+    def ledger_date(self, csv_date):
+        """Return csv_date formatted for ledger, without parsing it when
+        no conversion is needed.
+        """
+        if self.reformat:
+            return self.convert(csv_date)[1]
+        return csv_date
+
+    def oldest_ordinal(self, skip_older_than):
+        """Return the ordinal of the oldest day to keep, or None to keep
+        all entries.
+        """
+        if skip_older_than < 0:
+            return None
+        return self.today - skip_older_than
+
+
+def template_addons(options):
+    """Return the addon field names configured in options."""
+    return options.addons.keys() if 'addons' in options else ()
+
+
+def _single_line(value):
+    """Return value with its line breaks replaced by a space."""
+    if '\n' in value or '\r' in value:
+        return NEWLINE_REGEX.sub(' ', value)
+    return value
+
+
 class Entry:
     """
     This represents one entry in the CSV file.
     """
 
-    def __init__(self, fields, raw_csv, options):
+    def __init__(self, fields, raw_csv, options, template=None, plan=None):
         """Parameters:
         fields: list of fields read from one line of the CSV file
         raw_csv: unprocessed line from CSV file
         options: from CLI args and config file
+        template: TransactionTemplate shared by all entries, loaded from
+                  options if not given
+        plan: ColumnPlan shared by all entries, built from options if not
+              given
         """
 
         self.options = options
+        self.fields = fields
 
-        if 'addons' in options:
-            self.addons = dict((k, fields[v - 1])
-                               for k, v in options.addons.items())
-        else:
-            self.addons = dict()
+        if plan is None:
+            plan = ColumnPlan(options)
+
+        self.addons = {k: _single_line(fields[i]) for k, i in plan.addons}
 
         # Get the date and convert it into a ledger formatted date.
-        self.date = fields[options.date - 1].strip()
-        entry_date = datetime.strptime(self.date, options.csv_date_format)
-        if options.ledger_date_format:
-            if options.ledger_date_format != options.csv_date_format:
-                self.date = (datetime
-                             .strptime(self.date, options.csv_date_format)
-                             .strftime(options.ledger_date_format))
+        _, self.date, self.ordinal = plan.dates.convert(
+            fields[plan.date].strip())
 
         # determine how many days old this entry is
-        self.days_old = (datetime.now()-entry_date).days
+        self.days_old = plan.dates.today - self.ordinal
 
         # convert effective dates
-        if options.effective_date:
-            self.effective_date = fields[options.effective_date - 1]
-            if options.ledger_date_format:
-                if options.ledger_date_format != options.csv_date_format:
-                    self.effective_date = (datetime
-                                 .strptime(self.effective_date, options.csv_date_format)
-                                 .strftime(options.ledger_date_format))
+        if plan.effective_date is not None:
+            self.effective_date = plan.dates.ledger_date(
+                fields[plan.effective_date])
         else:
             self.effective_date = ""
 
+        # a quoted field may span lines, which a payee can not
+        self.desc = ' '.join([_single_line(fields[index]).strip()
+                              for index in plan.desc]).strip()
 
-        desc = []
-        for index in re.compile(',\s*').split(options.desc):
-            desc.append(fields[int(index) - 1].strip())
-        self.desc = ' '.join(desc).strip()
-
-        self.credit = get_field_at_index(fields, options.credit, options.csv_decimal_comma, options.ledger_decimal_comma)
-        self.debit = get_field_at_index(fields, options.debit, options.csv_decimal_comma, options.ledger_decimal_comma)
+        self.credit = plan.credit(fields)
+        self.debit = plan.debit(fields)
         if self.credit  and self.debit and atof(self.credit) == 0:
             self.credit = ''
         elif self.credit and self.debit and atof(self.debit) == 0:
@@ -547,13 +960,14 @@ class Entry:
             options, 'credit_currency', self.currency)
         self.cleared_character = options.cleared_character
 
-        if options.template_file:
-            with open(options.template_file, 'r', encoding='utf-8') as f:
-                self.transaction_template = f.read()
-        else:
-            self.transaction_template = ""
+        if template is None:
+            template = TransactionTemplate.from_file(
+                options.template_file, template_addons(options))
+        self.transaction_template = template
 
-        self.raw_csv = raw_csv.strip()
+        # keep the CSV comment on one line, with its line breaks escaped
+        self.raw_csv = (raw_csv.strip()
+                        .replace('\r', '\\r').replace('\n', '\\n'))
 
         # We also record this - in future we may use it to avoid duplication
         #self.md5sum = hashlib.md5(self.raw_csv.encode('utf-8')).hexdigest()
@@ -574,10 +988,7 @@ class Entry:
         Return a formatted journal entry recording this Entry against
         the specified Ledger account
         """
-        template = (self.transaction_template
-                    if self.transaction_template else DEFAULT_TEMPLATE)
-        uuid_regex = re.compile(r"UUID:", re.IGNORECASE)
-        uuid = [v for v in tags if uuid_regex.match(v)]
+        uuid = [v for v in tags if UUID_REGEX.match(v)]
         if uuid:
             uuid = uuid[0]
             tags.remove(uuid)
@@ -614,11 +1025,7 @@ class Entry:
             'csv': self.raw_csv}
         format_data.update(self.addons)
 
-        # generate and clean output
-        output_lines = template.format(**format_data).split('\n')
-        output = '\n'.join([x.rstrip() for x in output_lines if x.strip()]) + '\n'
-
-        return output
+        return self.transaction_template.render(format_data)
 
     def journal_entry(self, transaction_index, payee, debit_account, tags):
         return self._build_entry_str(transaction_index, payee, self.credit_account, debit_account, tags)
@@ -627,68 +1034,527 @@ class Entry:
         return self._build_entry_str(transaction_index, payee, account, transfer_to, tags)
 
 
-def get_field_at_index(fields, index, csv_decimal_comma, ledger_decimal_comma):
+def amount_parser(index, csv_decimal_comma, ledger_decimal_comma):
     """
-    Get the field at the given index.
-    If the index is less than 0, then we invert the sign of
-    the field at the given index
+    Return a function getting the amount at the given index from the
+    fields of a CSV row. If the index is less than 0, the sign of the
+    field at the opposite index is inverted, and 0 gives no amount.
     """
-    if index == 0 or index > len(fields):
-        return ""
+    if index == 0:
+        return lambda fields: ""
 
-    if csv_decimal_comma:
-        decimal_separator = ','
+    remove_non_number = _NON_NUMBER_REGEXES[bool(csv_decimal_comma)].sub
+    position = abs(index) - 1
+    if csv_decimal_comma and not ledger_decimal_comma:
+        separators = (',', '.')
+    elif not csv_decimal_comma and ledger_decimal_comma:
+        separators = ('.', ',')
     else:
-        decimal_separator = '.'
-
-    re_non_number = '[^-0-9' + decimal_separator + ']'
-
-    raw_value = fields[abs(index) - 1]
-    # Add negative symbol to raw_value if between parentheses
-    # E.g.  ($13.37) becomes -$13.37
-    if raw_value.startswith("(") and raw_value.endswith(")"):
-        raw_value = "-" + raw_value[1:-1]
-
-    value = re.sub(re_non_number, '', raw_value)
-    # Invert sign of value if index is negative.
-    if index < 0:
-        if value.startswith("-"):
-            value = value[1:]
-        elif value == "":
-            value = ""
-        else:
-            value = "-" + value
+        separators = None
+
+    def parse(fields):
+        if index > len(fields):
+            return ""
+
+        raw_value = fields[position]
+        # Add negative symbol to raw_value if between parentheses
+        # E.g.  ($13.37) becomes -$13.37
+        if raw_value.startswith("(") and raw_value.endswith(")"):
+            raw_value = "-" + raw_value[1:-1]
+
+        value = remove_non_number('', raw_value)
+        # Invert sign of value if index is negative.
+        if index < 0 and value:
+            if value.startswith("-"):
+                value = value[1:]
+            else:
+                value = "-" + value
 
-    if csv_decimal_comma and not ledger_decimal_comma:
-        value = value.replace(',', '.')
-    if not csv_decimal_comma and ledger_decimal_comma:
-        value = value.replace('.', ',')
+        if separators:
+            value = value.replace(*separators)
+        return value
 
-    return value
+    return parse
 
 
-def csv_md5sum_from_ledger(ledger_file):
-    with open(ledger_file, encoding="utf-8") as f:
-        lines = f.read()
-        include_files = re.findall(r"include\s+(.*?)\s+", lines)
-    pathes = [ledger_file, ] + include_files
-    csv_comments = set()
-    md5sum_hashes = set()
-    pattern = re.compile(r"^\s*[;#]\s*CSV:\s*(.*?)\s*$")
-    pattern1 = re.compile(r"^\s*[;#]\s*MD5Sum:\s*(.*?)\s*$")
-    for path in pathes:
+class _RecordSource:
+    """
+    Iterator over lines, given to csv.reader, remembering the lines read
+    since the last record so the exact source text of records is known.
+    """
+
+    def __init__(self, lines):
+        self._lines = iter(lines)
+        self._consumed = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        line = next(self._lines)
+        self._consumed.append(line)
+        return line
+
+    def take(self):
+        """Return the text read since the previous call."""
+        text = ''.join(self._consumed)
+        self._consumed.clear()
+        return text
+
+
+def read_csv_records(in_file, skip_lines, delimiter):
+    """
+    Yield (fields, raw_csv) for each record of in_file after the first
+    skip_lines lines, reading in_file incrementally. raw_csv is the
+    source text of the record, which spans several lines when a quoted
+    field contains newlines.
+    """
+    lines = iter(in_file)
+    for _ in itertools.islice(lines, skip_lines):
+        pass
+
+    head = list(itertools.islice(lines, 3))
+    dialect = sniff_dialect(head, delimiter)
+
+    source = _RecordSource(itertools.chain(head, lines))
+    for fields in csv.reader(source, dialect):
+        yield fields, source.take()
+
+
+def read_csv_records_reversed(in_file, skip_lines, delimiter,
+                              block_size=1024):
+    """
+    Yield the records of read_csv_records, last record first, without
+    holding the whole file in memory.
+
+    A first pass notes the position of every block_size-th record, then
+    blocks are read again from the last one to the first and each block
+    is yielded in reverse. Input which is not seekable, like stdin, is
+    first copied to a temporary file.
+    """
+    spill = None
+    if not in_file.seekable():
+        spill = tempfile.TemporaryFile('w+', encoding='utf-8', newline='')
+        shutil.copyfileobj(in_file, spill)
+        spill.seek(0)
+        in_file = spill
+
+    try:
+        # readline() is used instead of iterating over in_file, because
+        # iterating disables tell()
+        lines = iter(in_file.readline, '')
+        for _ in itertools.islice(lines, skip_lines):
+            pass
+
+        start = in_file.tell()
+        dialect = sniff_dialect(list(itertools.islice(lines, 3)), delimiter)
+        in_file.seek(start)
+
+        positions = []
+        reader = csv.reader(iter(in_file.readline, ''), dialect)
+        while True:
+            positions.append(in_file.tell())
+            if sum(1 for _ in itertools.islice(reader, block_size)) < block_size:
+                break
+
+        for position in reversed(positions):
+            in_file.seek(position)
+            source = _RecordSource(iter(in_file.readline, ''))
+            block = [(fields, source.take()) for fields in
+                     itertools.islice(csv.reader(source, dialect), block_size)]
+            yield from reversed(block)
+    finally:
+        if spill is not None:
+            spill.close()
+
+
+def sniff_dialect(lines, delimiter):
+    """Guess the CSV dialect from the first lines of the file, or return
+    None if it can't be guessed.
+    """
+    try:
+        return csv.Sniffer().sniff("".join(lines), delimiter)
+    except csv.Error:  # can't guess specific dialect, try without one
+        return None
+
+
+def skip_older_records(records, plan, oldest_ordinal, date_sorted=False):
+    """
+    Drop the (fields, raw_csv) records dated before oldest_ordinal,
+    parsing only their date, before any other work is done on them.
+
+    When date_sorted is set, records are known to be in date order, and
+    reading stops at the first too old record following a kept or a more
+    recent record: all remaining records are older.
+    """
+    kept = False
+    previous = None
+    for record in records:
+        ordinal = plan.dates.convert(record[0][plan.date].strip())[2]
+        if ordinal >= oldest_ordinal:
+            kept = True
+            yield record
+        elif date_sorted and (kept or (previous is not None and
+                                       ordinal < previous)):
+            return
+        previous = ordinal
+
+
+def read_records(in_file, options):
+    """
+    Return the (fields, raw_csv) records of in_file, in reverse order
+    with options.reverse.
+    """
+    if options.reverse:
+        return read_csv_records_reversed(in_file, options.skip_lines,
+                                         options.delimiter)
+    return read_csv_records(in_file, options.skip_lines, options.delimiter)
+
+
+def filter_records(records, options, plan):
+    """
+    Drop the empty (fields, raw_csv) records and those older than
+    options.skip_older_than.
+    """
+    records = (record for record in records if len(record[0]) != 0)
+    oldest_ordinal = plan.dates.oldest_ordinal(options.skip_older_than)
+    if oldest_ordinal is not None:
+        records = skip_older_records(records, plan, oldest_ordinal,
+                                     options.date_sorted)
+    return records
+
+
+def csv_entries(records, options, template, plan):
+    """
+    Yield the Entry of each (fields, raw_csv) record, skipping empty
+    records and those older than options.skip_older_than.
+    """
+    for fields, raw_csv in filter_records(records, options, plan):
+        yield Entry(fields, raw_csv, options, template, plan)
+
+
+class JournalCache:
+    """
+    What was found in ledger files, kept on disk between runs and keyed
+    by file path, size and modification time. An unchanged file is not
+    read again, and a file which was only appended to is read from where
+    the previous scan stopped. Accounts and payees are only collected by
+    scans of the vocabulary, a file scanned without them being read again
+    when they are needed.
+    """
+
+    VERSION = 3
+
+    # What is found in a file, kept as sorted lists in the cache file
+    SETS = ('csv_comments', 'md5sums', 'accounts', 'payees')
+
+    # Bytes checked to tell that a file was appended to, not rewritten
+    CHECK_SIZE = 4096
+
+    # A file modified this close to its scan may change again without
+    # its modification time changing, so it is read again
+    RACY_NS = 2 * 10**9
+
+    def __init__(self, cache_file=None):
+        """cache_file: where to keep the cache, or None to only scan."""
+        self.cache_file = cache_file
+        self.files = {}
+        self.modified = False
+        if cache_file and os.path.exists(cache_file):
+            try:
+                with open(cache_file, encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('version') == self.VERSION:
+                    self.files = data['files']
+            except (OSError, ValueError, KeyError):
+                self.files = {}  # unreadable cache, rebuild it
+
+    def scan(self, path, vocabulary=True):
+        """
+        Return a dict with the sets of 'csv_comments', 'md5sums',
+        'accounts' and 'payees', and the list of 'includes', found in the
+        ledger file at path. Without vocabulary, accounts and payees may
+        be left empty.
+        """
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        record = self.files.get(key)
+        if record is not None and record['mtime'] >= record['scanned'] - self.RACY_NS:
+            record = None
+        if record is not None and vocabulary and not record['vocabulary']:
+            record = None
+        if (record is not None and record['size'] == stat.st_size and
+                record['mtime'] == stat.st_mtime_ns):
+            return self._found(record, path)
+
+        with open(path, 'rb') as f:
+            if record is None or not self._appended(f, record, stat):
+                record = dict({name: [] for name in self.SETS},
+                              offset=0, check='', includes=[],
+                              in_transaction=False, vocabulary=vocabulary)
+            # a record of the vocabulary is kept complete
+            vocabulary = record['vocabulary']
+            found = self._found(record)
+            f.seek(record['offset'])
+            offset = record['offset']
+            tail = b''
+            for line in f:
+                if not line.endswith(b'\n'):
+                    # incomplete last line, read again on next scan
+                    tail = line
+                    break
+                _scan_journal_line(line.decode('utf-8'), found, vocabulary)
+                offset += len(line)
+            f.seek(max(0, offset - self.CHECK_SIZE))
+            check = hashlib.md5(f.read(offset - f.tell())).hexdigest()
+
+        self.files[key] = dict(
+            {name: sorted(found[name]) for name in self.SETS},
+            size=stat.st_size, mtime=stat.st_mtime_ns,
+            scanned=time.time_ns(), offset=offset, check=check,
+            includes=found['includes'],
+            in_transaction=found['in_transaction'], vocabulary=vocabulary)
+        self.modified = True
+        if tail:
+            _scan_journal_line(tail.decode('utf-8'), found, vocabulary)
+        return found
+
+    def _appended(self, f, record, stat):
+        """Tell if the file only had data appended since record."""
+        offset = record['offset']
+        if stat.st_size < offset:
+            return False
+        f.seek(max(0, offset - self.CHECK_SIZE))
+        return hashlib.md5(f.read(offset - f.tell())).hexdigest() == record['check']
+
+    @staticmethod
+    def _found(record, path=None):
+        """Return the found dict of record, including the incomplete last
+        line of the file at path if given.
+        """
+        found = {name: set(record[name]) for name in JournalCache.SETS}
+        found['includes'] = list(record['includes'])
+        found['in_transaction'] = record['in_transaction']
+        if path is not None and record['offset'] < record['size']:
+            # incomplete last line, which is never cached
+            with open(path, 'rb') as f:
+                f.seek(record['offset'])
+                _scan_journal_line(f.read().decode('utf-8'), found,
+                                   record['vocabulary'])
+        return found
+
+    def save(self):
+        """Write the cache file, if anything changed."""
+        if not self.cache_file or not self.modified:
+            return
+        _write_json(self.cache_file,
+                    {'version': self.VERSION, 'files': self.files})
+        self.modified = False
+
+
+CSV_COMMENT_REGEX = re.compile(r"^\s*[;#]\s*CSV:\s*(.*?)\s*$")
+MD5SUM_COMMENT_REGEX = re.compile(r"^\s*[;#]\s*MD5Sum:\s*(.*?)\s*$")
+INCLUDE_REGEX = re.compile(r"include\s+(.*?)\s+")
+
+
+TRANSACTION_REGEX = re.compile(
+    r"^[0-9]\S*\s+(?:[*!]\s*)?(?:\([^)]*\)\s*)?(.*?)(?:(?:\t|  )\s*;.*)?\s*$")
+DIRECTIVE_REGEX = re.compile(r"^(account|payee)\s+(.*?)\s*$")
+AMOUNT_SEPARATOR_REGEX = re.compile(r"\t|  ")
+
+
+def _scan_journal_line(line, found, vocabulary=True):
+    """Add what one line of a ledger file contains to found, leaving
+    out accounts and payees without vocabulary."""
+    m = CSV_COMMENT_REGEX.match(line)
+    if m:
+        found['csv_comments'].add(m.group(1))
+    m = MD5SUM_COMMENT_REGEX.match(line)
+    if m:
+        found['md5sums'].add(m.group(1))
+    if 'include' in line:
+        found['includes'].extend(INCLUDE_REGEX.findall(line))
+    if not vocabulary:
+        return
+
+    if line[:1] in (' ', '\t'):
+        # posting, if in a transaction
+        text = line.strip()
+        if not found['in_transaction'] or not text or text[0] in ';#%|':
+            return
+        if text[0] in '*!':
+            text = text[1:].lstrip()
+        account = AMOUNT_SEPARATOR_REGEX.split(text, 1)[0].rstrip()
+        if account[:1] in '([' and account[-1:] in ')]':
+            account = account[1:-1]
+        if account:
+            found['accounts'].add(account)
+        return
+
+    found['in_transaction'] = line[:1] in ('=', '~') or line[:1].isdigit()
+    m = TRANSACTION_REGEX.match(line)
+    if m:
+        if m.group(1):
+            found['payees'].add(m.group(1))
+        return
+    m = DIRECTIVE_REGEX.match(line)
+    if m:
+        found[m.group(1) + 's'].add(m.group(2))
+
+
+def csv_md5sum_from_ledger(ledger_file, cache=None):
+    """
+    Return the sets of CSV comments and MD5Sum comments found in the
+    ledger file and the files it includes. cache is the JournalCache to
+    use, if any.
+    """
+    if cache is None:
+        cache = JournalCache()
+    # the ledger file is scanned once, for its includes and its comments
+    ledger = cache.scan(ledger_file, vocabulary=False)
+    csv_comments = set(ledger['csv_comments'])
+    md5sum_hashes = set(ledger['md5sums'])
+    for path in ledger['includes']:
         for fname in glob.glob(path):
-            with open(fname, encoding="utf-8") as f:
-                for line in f:
-                    m = pattern.match(line)
-                    if m:
-                        csv_comments.add(m.group(1))
-                    m = pattern1.match(line)
-                    if m:
-                        md5sum_hashes.add(m.group(1))
+            found = cache.scan(fname, vocabulary=False)
+            csv_comments.update(found['csv_comments'])
+            md5sum_hashes.update(found['md5sums'])
+    cache.save()
     return csv_comments, md5sum_hashes
 
 
+def journal_files(ledger_file, cache, globs=None, vocabulary=True):
+    """
+    Yield (path, found) for the ledger file and every file it includes,
+    found being what JournalCache.scan returns for path. Includes are
+    relative to the including file, as for ledger. The files matched by
+    each include pattern are added to the dict globs, if given. Without
+    vocabulary, found may lack accounts and payees.
+    """
+    seen = set()
+    pending = [os.path.abspath(ledger_file)]
+    while pending:
+        path = pending.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+        found = cache.scan(path, vocabulary)
+        yield path, found
+        directory = os.path.dirname(path)
+        for include in reversed(found['includes']):
+            pattern = os.path.join(directory, os.path.expanduser(include))
+            matches = sorted(glob.glob(pattern), reverse=True)
+            if globs is not None:
+                globs[pattern] = matches
+            pending.extend(matches)
+
+
+def scan_journal(ledger_file, cache=None):
+    """
+    Read the ledger file and the files it includes once, without running
+    ledger, and return the sets of accounts, payees, CSV comments and
+    MD5Sum comments found in them. cache is the JournalCache to use, if
+    any.
+    """
+    if cache is None:
+        cache = JournalCache()
+    accounts = set()
+    payees = set()
+    csv_comments = set()
+    md5sum_hashes = set()
+    for _, found in journal_files(ledger_file, cache):
+        accounts.update(found['accounts'])
+        payees.update(found['payees'])
+        csv_comments.update(found['csv_comments'])
+        md5sum_hashes.update(found['md5sums'])
+    cache.save()
+    return accounts, payees, csv_comments, md5sum_hashes
+
+
+class VocabularyCache:
+    """
+    Payees, accounts and tags read from files, kept on disk between runs.
+    Each entry is valid as long as none of the files it was read from
+    changed size or modification time, and the glob patterns of their
+    includes still match the same files.
+    """
+
+    VERSION = 2
+
+    def __init__(self, cache_file=None):
+        """cache_file: where to keep the cache, or None to not cache."""
+        self.cache_file = cache_file
+        self.entries = {}
+        self.modified = False
+        if cache_file and os.path.exists(cache_file):
+            try:
+                with open(cache_file, encoding='utf-8') as f:
+                    data = json.load(f)
+                if data.get('version') == self.VERSION:
+                    self.entries = data['entries']
+            except (OSError, ValueError, KeyError):
+                self.entries = {}  # unreadable cache, rebuild it
+
+    def get(self, key):
+        """
+        Return the dict of sets cached under key, or None if there is
+        none or one of its files changed.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        for path, (size, mtime) in entry['files'].items():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            if (stat.st_size != size or stat.st_mtime_ns != mtime or
+                    mtime >= entry['started'] - JournalCache.RACY_NS):
+                return None
+        for pattern, matches in entry['globs'].items():
+            if sorted(glob.glob(pattern)) != matches:
+                return None
+        return {name: set(values) for name, values in entry['values'].items()}
+
+    def put(self, key, started, paths, values, globs=None):
+        """
+        Cache the dict of sets values under key, as read from paths from
+        the time.time_ns() started. globs is a dict of the glob patterns
+        which gave paths, and of the files they matched.
+        """
+        if not self.cache_file:
+            return
+        files = {}
+        for path in paths:
+            stat = os.stat(path)
+            files[os.path.abspath(path)] = [stat.st_size, stat.st_mtime_ns]
+        self.entries[key] = {
+            'started': started, 'files': files,
+            'globs': {pattern: sorted(matches)
+                      for pattern, matches in (globs or {}).items()},
+            'values': {name: sorted(v) for name, v in values.items()}}
+        self.modified = True
+
+    def save(self):
+        """Write the cache file, if anything changed."""
+        if not self.cache_file or not self.modified:
+            return
+        _write_json(self.cache_file,
+                    {'version': self.VERSION, 'entries': self.entries})
+        self.modified = False
+
+
+def _write_json(path, data):
+    """Replace the file at path with data as JSON, atomically."""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=directory or '.',
+                                     delete=False) as f:
+        json.dump(data, f)
+    os.replace(f.name, path)
+
+
 def payees_from_ledger(ledger_file, ledger_binary_file):
     return from_ledger(ledger_file, ledger_binary_file, 'payees')
 
@@ -752,6 +1618,119 @@ def read_mapping_file(map_file) -> [MappingInfo]:
     return mappings
 
 
+class MappingIndex:
+    """
+    Lookup structure over a list of MappingInfo giving the same result as
+    a linear scan where the last matching mapping wins.
+
+    Exact patterns are kept in a dict. Regex patterns are combined into
+    alternations ordered from the most recent mapping to the oldest, so
+    the first alternative to match is the winning one. Patterns that can
+    not be embedded in an alternation (capture groups, global flags) are
+    tried one by one, most recent first.
+    """
+
+    # Number of regexes per combined alternation. The re engine saves
+    # all groups on each alternative, so one huge alternation is slow.
+    CHUNK_SIZE = 64
+
+    def __init__(self, mappings=()):
+        self.mappings = []
+        self._exact = {}
+        self._combinable = []  # indexes of regex mappings, oldest first
+        self._fallback = []    # indexes of regex mappings, oldest first
+        self._chunks = []      # (compiled alternation, [mapping indexes])
+        for mapping in mappings:
+            self.append(mapping)
+
+    def __len__(self):
+        return len(self.mappings)
+
+    def __iter__(self):
+        return iter(self.mappings)
+
+    def __getstate__(self):
+        # combined regexes are rebuilt on first lookup, by the process
+        # pool workers this index is sent to
+        state = self.__dict__.copy()
+        state['_chunks'] = None
+        return state
+
+    def append(self, mapping):
+        """Add a mapping, which wins over all mappings already present."""
+        index = len(self.mappings)
+        self.mappings.append(mapping)
+        pattern = mapping.pattern
+        if isinstance(pattern, str):
+            self._exact[pattern] = index
+        elif pattern.groups == 0 and pattern.flags == _DEFAULT_REGEX_FLAGS:
+            self._combinable.append(index)
+            self._chunks = None
+        else:
+            self._fallback.append(index)
+
+    def _build_chunks(self):
+        chunks = []
+        newest_first = self._combinable[::-1]
+        for start in range(0, len(newest_first), self.CHUNK_SIZE):
+            indexes = newest_first[start:start + self.CHUNK_SIZE]
+            regex = re.compile('|'.join(
+                '({0})'.format(self.mappings[i].pattern.pattern)
+                for i in indexes))
+            chunks.append((regex, indexes))
+        self._chunks = chunks
+        return chunks
+
+    def lookup(self, desc):
+        """
+        Return (mapping, match) for the mapping winning on desc. match is
+        the regex match object, or None for exact patterns. Return
+        (None, None) if no mapping matches.
+        """
+        best = self._exact.get(desc, -1)
+
+        chunks = self._chunks
+        if chunks is None:
+            chunks = self._build_chunks()
+        for regex, indexes in chunks:
+            if indexes[0] <= best:
+                break
+            match = regex.match(desc)
+            if match:
+                best = max(best, indexes[match.lastindex - 1])
+                break
+
+        for index in reversed(self._fallback):
+            if index <= best:
+                break
+            if self.mappings[index].pattern.match(desc):
+                best = index
+                break
+
+        if best < 0:
+            return None, None
+        mapping = self.mappings[best]
+        if isinstance(mapping.pattern, str):
+            return mapping, None
+        return mapping, mapping.pattern.match(desc)
+
+
+def map_entry(desc, mapping_index):
+    """
+    Return (payee, account, tags, transfer_to, transfer_to_file) from the
+    mapping winning on desc, or None if no mapping matches.
+    """
+    mapping, match = mapping_index.lookup(desc)
+    if mapping is None:
+        return None
+    payee = mapping.payee
+    # perform regexp substitution if captures were used
+    if match is not None and match.groups():
+        payee = mapping.pattern.sub(mapping.payee, desc)
+    return (payee, mapping.account, mapping.tags,
+            mapping.transfer_to, mapping.transfer_to_file)
+
+
 def read_accounts_file(account_file):
     """ Process each line in the specified account file looking for account
         definitions. An account definition is a line containing the word
@@ -773,11 +1752,240 @@ def read_accounts_file(account_file):
     return accounts
 
 
-def append_mapping_file(map_file, desc, payee, account, tags):
-    if map_file:
-        with open(map_file, 'a', encoding='utf-8', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([desc, payee, account] + tags)
+class MappingWriter:
+    """
+    Appends new mappings to the mapping file through one handle kept open
+    for the session. Rows are buffered, and written when one is appended
+    flush_interval seconds after they were last written, 0 writing each at
+    once, when flushed and when the writer is closed. With compact, the mapping file is
+    compacted once closed, see compact_mapping_file.
+    """
+
+    def __init__(self, map_file, flush_interval=0, compact=False):
+        self.map_file = map_file
+        self.flush_interval = flush_interval
+        self.compact = compact
+        self._file = None
+        self._writer = None
+        self._rows = []
+        self._flushed_at = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, desc, payee, account, tags):
+        if not self.map_file:
+            return
+        self._rows.append([desc, payee, account] + tags)
+        if time.monotonic() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows to the mapping file."""
+        if self._rows:
+            if self._file is None:
+                try:
+                    with open(self.map_file, 'rb') as f:
+                        if f.seek(0, os.SEEK_END):
+                            f.seek(-1, os.SEEK_END)
+                        last = f.read(1)
+                except FileNotFoundError:
+                    last = b''
+                self._file = open(self.map_file, 'a', encoding='utf-8',
+                                  newline='')
+                # do not extend a last row missing its line end
+                if last not in (b'', b'\n', b'\r'):
+                    self._file.write('\n')
+                self._writer = csv.writer(self._file)
+            self._writer.writerows(self._rows)
+            self._rows.clear()
+            self._file.flush()
+        self._flushed_at = time.monotonic()
+
+    def close(self):
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self.compact and self.map_file:
+            compact_mapping_file(self.map_file)
+
+
+def compact_mapping_file(map_file):
+    """
+    Remove from map_file the mappings followed by a later one for the
+    same pattern, which always wins over them. The remaining rows keep
+    their order, and map_file is atomically replaced. Return the number
+    of rows removed.
+    """
+    with open(map_file, 'r', encoding='utf-8', newline='') as f:
+        rows = list(csv.reader(f))
+    last_row = {}
+    for i, row in enumerate(rows):
+        if len(row) > 2:
+            last_row[row[0].strip()] = i
+    kept = [row for i, row in enumerate(rows)
+            if len(row) <= 2 or last_row[row[0].strip()] == i]
+    removed = len(rows) - len(kept)
+    if removed:
+        with atomic_file(map_file, newline='') as f:
+            csv.writer(f).writerows(kept)
+    return removed
+
+
+def journal_cache_key(options):
+    """Return the key of the JournalCache of options in shared startup data."""
+    return ('journal_cache', options.cache_dir or '')
+
+
+def read_startup_data(options, shared=None, stats=None):
+    """
+    Query the ledger file, and read the mapping and accounts files,
+    concurrently: the ledger queries mostly wait on ledger subprocesses.
+    With a cache directory, payees and accounts which were already read
+    from unchanged files are taken from the VocabularyCache instead.
+
+    shared is a dict keeping what was read from each file, for runs of
+    several accounts in one process: files already in it are not read
+    again, and the runs share their md5sum_hashes and mapping_index, and
+    the JournalCache.
+    stats is the RunStats where to add the time of each task, if any.
+
+    Return a dotdict with the possible accounts, payees and tags, the
+    csv_comments and md5sum_hashes of the ledger file, and the
+    mapping_index.
+    """
+    if shared is None:
+        shared = {}
+    sources = {}
+    for kind, path in (('ledger', options.ledger_file),
+                       ('mapping', options.mapping_file),
+                       ('accounts', options.accounts_file)):
+        if path:
+            sources[kind] = (kind, os.path.abspath(path))
+    loaded = {kind: shared[source] for kind, source in sources.items()
+              if source in shared}
+
+    # The journal cache is kept in shared, so that later runs only read
+    # again the ledger files which changed
+    journal_cache = shared.get(journal_cache_key(options))
+    vocabulary_cache = VocabularyCache()
+    if options.cache_dir:
+        cache_dir = os.path.expanduser(options.cache_dir)
+        if journal_cache is None:
+            journal_cache = JournalCache(os.path.join(cache_dir, 'journal.json'))
+        vocabulary_cache = VocabularyCache(
+            os.path.join(cache_dir, 'vocabulary.json'))
+    if journal_cache is None:
+        journal_cache = JournalCache()
+    shared[journal_cache_key(options)] = journal_cache
+
+    def cached(kind, path):
+        key = '{0}:{1}'.format(kind, os.path.abspath(path))
+        return key, time.time_ns(), vocabulary_cache.get(key)
+
+    def timed(name, task):
+        return task if stats is None else stats.timed('startup.' + name, task)
+
+    vocabularies = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
+        tasks = {}
+        if 'ledger' in sources and 'ledger' not in loaded:
+            if (options.native_scanner or
+                    not (options.ledger_binary or shutil.which('ledger'))):
+                tasks['journal'] = executor.submit(
+                    timed('journal', scan_journal),
+                    options.ledger_file, journal_cache)
+            else:
+                ledger_key, ledger_started, vocabulary = cached(
+                    'ledger', options.ledger_file)
+                if vocabulary is None:
+                    tasks['ledger_accounts'] = executor.submit(
+                        timed('ledger_accounts', accounts_from_ledger),
+                        options.ledger_file, options.ledger_binary)
+                    tasks['ledger_payees'] = executor.submit(
+                        timed('ledger_payees', payees_from_ledger),
+                        options.ledger_file, options.ledger_binary)
+                else:
+                    vocabularies['ledger'] = vocabulary
+                tasks['comments'] = executor.submit(
+                    timed('comments', csv_md5sum_from_ledger),
+                    options.ledger_file, journal_cache)
+        if 'mapping' in sources and 'mapping' not in loaded:
+            mapping_key, mapping_started, mapping_vocabulary = cached(
+                'mapping', options.mapping_file)
+            tasks['mappings'] = executor.submit(
+                timed('mappings', read_mapping_file),
+                options.mapping_file)
+        if 'accounts' in sources and 'accounts' not in loaded:
+            accounts_key, accounts_started, vocabulary = cached(
+                'accounts', options.accounts_file)
+            if vocabulary is None:
+                tasks['allowed_accounts'] = executor.submit(
+                    timed('allowed_accounts', read_accounts_file),
+                    options.accounts_file)
+            else:
+                loaded['accounts'] = {'vocabulary': vocabulary}
+
+        # result() raises again any exception of the task
+        results = {name: task.result() for name, task in tasks.items()}
+
+    if 'journal' in results:
+        accounts, payees, csv_comments, md5sum_hashes = results['journal']
+        loaded['ledger'] = {
+            'vocabulary': {'accounts': accounts, 'payees': payees},
+            'csv_comments': csv_comments, 'md5sum_hashes': md5sum_hashes}
+    if 'ledger_accounts' in results:
+        vocabularies['ledger'] = {'accounts': results['ledger_accounts'],
+                                  'payees': results['ledger_payees']}
+        if vocabulary_cache.cache_file:
+            globs = {}
+            vocabulary_cache.put(
+                ledger_key, ledger_started,
+                [path for path, _ in journal_files(
+                    options.ledger_file, journal_cache, globs,
+                    vocabulary=False)],
+                vocabularies['ledger'], globs)
+    if 'comments' in results:
+        csv_comments, md5sum_hashes = results['comments']
+        loaded['ledger'] = {
+            'vocabulary': vocabularies['ledger'],
+            'csv_comments': csv_comments, 'md5sum_hashes': md5sum_hashes}
+    if 'mappings' in results:
+        mapping_index = MappingIndex(results['mappings'])
+        if mapping_vocabulary is None:
+            mapping_vocabulary = {'payees': set(), 'accounts': set(), 'tags': set()}
+            for m in mapping_index:
+                mapping_vocabulary['payees'].add(m.payee)
+                mapping_vocabulary['accounts'].add(m.account)
+                mapping_vocabulary['tags'].update(m.tags)
+            vocabulary_cache.put(mapping_key, mapping_started,
+                                 [options.mapping_file], mapping_vocabulary)
+        loaded['mapping'] = {'vocabulary': mapping_vocabulary,
+                             'mapping_index': mapping_index}
+    if 'allowed_accounts' in results:
+        vocabulary = {'accounts': set(results['allowed_accounts'])}
+        vocabulary_cache.put(accounts_key, accounts_started,
+                             [options.accounts_file], vocabulary)
+        loaded['accounts'] = {'vocabulary': vocabulary}
+
+    data = dotdict({
+        'accounts': set(), 'payees': set(), 'tags': set(),
+        'csv_comments': set(), 'md5sum_hashes': set(),
+        'mapping_index': MappingIndex()})
+    for kind, source in sources.items():
+        shared[source] = loaded[kind]
+        for name, values in loaded[kind]['vocabulary'].items():
+            data[name].update(values)
+        for name in ('csv_comments', 'md5sum_hashes', 'mapping_index'):
+            if name in loaded[kind]:
+                data[name] = loaded[kind][name]
+    journal_cache.save()
+    vocabulary_cache.save()
+    return data
 
 
 def tagify(value):
@@ -802,30 +2010,732 @@ def prompt_for_tags(prompt, values, default):
     return tags
 
 
-def prompt_for_value(prompt, values, default):
-
-    def completer(text, state):
-        for val in values:
-            if text.upper() in val.upper():
-                if not state:
-                    return val
-                else:
-                    state -= 1
-        return None
+class CompletionIndex:
+    """
+    Values offered for completion at a prompt. A text completes to the
+    values containing it, ignoring case. Values are indexed by their
+    n-grams, and results are kept per text, so completing while typing
+    only looks at the values which matched the text typed so far.
+    """
 
+    NGRAM_SIZE = 3
+
+    # Number of texts for which results are kept
+    MAX_RESULTS = 1024
+
+    def __init__(self, values=()):
+        self.values = []
+        self._upper = []
+        self._ids = {}
+        self._ngrams = None  # built on first use, quiet runs may not prompt
+        self._results = {}
+        for value in values:
+            self.add(value)
+
+    def __contains__(self, value):
+        return value in self._ids
+
+    def __iter__(self):
+        return iter(self.values)
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value):
+        """Add value, if not already present."""
+        if value in self._ids:
+            return
+        value_id = len(self.values)
+        upper = value.upper()
+        self._ids[value] = value_id
+        self.values.append(value)
+        self._upper.append(upper)
+        if self._ngrams is not None:
+            for ngram in self._ngrams_of(upper):
+                self._ngrams.setdefault(ngram, []).append(value_id)
+        self._results.clear()
+
+    def _ngrams_of(self, upper):
+        size = self.NGRAM_SIZE
+        return {upper[i:i + size] for i in range(len(upper) - size + 1)}
+
+    def complete(self, text):
+        """Return the values containing text, ignoring case."""
+        text = text.upper()
+        ids = self._results.get(text)
+        if ids is None:
+            ids = self._match(text)
+            if len(self._results) >= self.MAX_RESULTS:
+                self._results.clear()
+            self._results[text] = ids
+        return [self.values[value_id] for value_id in ids]
+
+    def _match(self, text):
+        # Candidates are the results of the longest text typed so far,
+        # or the values having the rarest n-gram of text, if fewer
+        candidates = None
+        for end in range(len(text) - 1, -1, -1):
+            if text[:end] in self._results:
+                candidates = self._results[text[:end]]
+                break
+        if len(text) >= self.NGRAM_SIZE:
+            if self._ngrams is None:
+                self._ngrams = {}
+                for value_id, upper in enumerate(self._upper):
+                    for ngram in self._ngrams_of(upper):
+                        self._ngrams.setdefault(ngram, []).append(value_id)
+            postings = min((self._ngrams.get(ngram, [])
+                            for ngram in self._ngrams_of(text)), key=len)
+            if candidates is None or len(postings) < len(candidates):
+                candidates = postings
+        if candidates is None:
+            candidates = range(len(self.values))
+        upper = self._upper
+        return [value_id for value_id in candidates if text in upper[value_id]]
+
+
+@functools.lru_cache(maxsize=None)
+def setup_readline():
+    """Configure readline completion, once per session."""
     # There are no word deliminators as each account name
     # is one word.  eg ':' and ' ' are valid parts of account
     # name and don't indicate a new word
     readline.set_completer_delims("")
-    readline.set_completer(completer)
     if readline.__doc__ and 'libedit' in readline.__doc__:
         readline.parse_and_bind("bind ^I rl_complete")
     else:
         readline.parse_and_bind("tab: complete")
 
+
+def prompt_for_value(prompt, values, default):
+    """values: CompletionIndex of the values offered for completion, or
+    any iterable of them.
+    """
+    if not isinstance(values, CompletionIndex):
+        values = CompletionIndex(values)
+    matches = []
+
+    def completer(text, state):
+        # readline asks for each match of text in turn, from state 0
+        if not state:
+            matches[:] = values.complete(text)
+        return matches[state] if state < len(matches) else None
+
+    setup_readline()
+    readline.set_completer(completer)
+
     return input('{0} [{1}] > '.format(prompt, default))
 
 
+_NO_PHASE = contextlib.nullcontext()
+
+
+class _Phase:
+    """Context adding the time spent in it to a phase of RunStats."""
+
+    __slots__ = ('stats', 'name', 'start')
+
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+
+    def __enter__(self):
+        self.stats._local.nested.append(0.0)
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        elapsed = time.perf_counter() - self.start
+        nested = self.stats._local.nested
+        # time of nested phases is only counted in them
+        seconds = elapsed - nested.pop()
+        if nested:
+            nested[-1] += elapsed
+        self.stats.phases[self.name] += seconds
+        for hook in self.stats.hooks:
+            hook(self.name, seconds)
+
+
+class RunStats:
+    """
+    Time spent in each phase of a run, and counts of rows and mappings,
+    reported by --stats. Time spent waiting on the user is kept in the
+    input phase, apart from compute time. Time spent in a phase entered
+    from another one, in the same thread, is only counted in the inner
+    phase.
+
+    Phases are only timed when enabled, and each hook is then called
+    with the name of the phase and the seconds spent in it, whenever a
+    phase ends.
+    """
+
+    def __init__(self, enabled=True, hooks=()):
+        self.enabled = enabled or bool(hooks)
+        self.hooks = list(hooks)
+        self.started = time.perf_counter()
+        self.phases = collections.defaultdict(float)
+        self.counts = collections.Counter()
+        self.mapping_profiles = {}
+        self._local = threading.local()
+
+    def mapping_profile(self, map_file, mapping_index):
+        """Return the MappingProfile of map_file, shared by the runs
+        using it."""
+        key = os.path.abspath(map_file)
+        if key not in self.mapping_profiles:
+            self.mapping_profiles[key] = MappingProfile(mapping_index)
+        return self.mapping_profiles[key]
+
+    def phase(self, name):
+        """Return a context adding the time spent in it to phase name."""
+        if not self.enabled:
+            return _NO_PHASE
+        if not hasattr(self._local, 'nested'):
+            self._local.nested = []
+        return _Phase(self, name)
+
+    def timed(self, name, function):
+        """Return function, adding the time of each call to phase name."""
+        if not self.enabled:
+            return function
+
+        @functools.wraps(function)
+        def timed_function(*args, **kwargs):
+            with self.phase(name):
+                return function(*args, **kwargs)
+        return timed_function
+
+    def timed_iter(self, name, iterable):
+        """Return the items of iterable, adding the time to get each one
+        to phase name."""
+        if not self.enabled:
+            return iterable
+        return self._timed_iter(name, iterable)
+
+    def _timed_iter(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def count_records(self, records):
+        """Return (fields, raw_csv) records, counting them."""
+        if not self.enabled:
+            return records
+        return self._count_records(records)
+
+    def _count_records(self, records):
+        for record in records:
+            self.counts['read'] += 1
+            if not record[0]:
+                self.counts['empty'] += 1
+            yield record
+
+    def report(self):
+        wall = time.perf_counter() - self.started
+        waiting = self.phases.get('input', 0.0)
+        counts = self.counts
+        rows = {name: counts[name] for name in
+                ('read', 'empty', 'duplicates', 'skipped', 'converted')}
+        rows['too_old'] = counts['read'] - counts['empty'] - counts['entries']
+        compute = wall - waiting
+        return {
+            'wall_seconds': wall,
+            'input_seconds': waiting,
+            'compute_seconds': compute,
+            'rows_per_second': counts['entries'] / compute if compute else 0.0,
+            'phases': dict(sorted(self.phases.items())),
+            'rows': rows,
+            'mappings': {name: counts[name] for name in
+                         ('hits', 'misses', 'learned')},
+        }
+
+    def write(self, stats_file=None):
+        """Print the report to stderr, or write it to stats_file as JSON."""
+        report = self.report()
+        if stats_file:
+            _write_json(stats_file, report)
+            return
+        print('wall time: {0:.3f}s, waiting for input: {1:.3f}s,'
+              ' compute: {2:.3f}s, {3:.0f} rows/s'
+              .format(report['wall_seconds'], report['input_seconds'],
+                      report['compute_seconds'], report['rows_per_second']),
+              file=sys.stderr)
+        for name, seconds in report['phases'].items():
+            print('  {0:<28} {1:10.3f}s'.format(name, seconds),
+                  file=sys.stderr)
+        print('rows: ' + ', '.join('{0} {1}'.format(name.replace('_', ' '), n)
+                                   for name, n in report['rows'].items()),
+              file=sys.stderr)
+        print('mappings: ' + ', '.join('{0} {1}'.format(name, n)
+                                       for name, n in report['mappings'].items()),
+              file=sys.stderr)
+
+    def write_mapping_report(self, report_file=None):
+        """
+        Print the mappings which never won a description to stderr, or
+        write the counters of all mappings to report_file as JSON.
+        """
+        report = {map_file: profile.rules()
+                  for map_file, profile in self.mapping_profiles.items()}
+        if report_file:
+            _write_json(report_file, report)
+            return
+        for map_file, rules in report.items():
+            print('{0}: {1} mappings'.format(map_file, len(rules)),
+                  file=sys.stderr)
+            for rule in rules:
+                if rule['hits']:
+                    continue
+                if rule['shadowed']:
+                    reason = 'always shadowed, matched {0} times'.format(
+                        rule['shadowed'])
+                else:
+                    reason = 'never matched'
+                print('  {0}: {1},{2},{3}: {4}'.format(
+                    rule['index'] + 1, rule['pattern'], rule['payee'],
+                    rule['account'], reason), file=sys.stderr)
+            slowest = sorted(rules, key=lambda rule: rule['seconds'],
+                             reverse=True)[:10]
+            print('  slowest:', file=sys.stderr)
+            for rule in slowest:
+                print('  {0}: {1}: {2:.6f}s'.format(
+                    rule['index'] + 1, rule['pattern'], rule['seconds']),
+                    file=sys.stderr)
+
+
+class MappingProfile:
+    """
+    Counts, for each mapping of a MappingIndex, the descriptions it won,
+    those it matched but a later mapping won, and the time spent trying
+    it, for --mapping-report. Every mapping is tried on each description,
+    which is much slower than MappingIndex.lookup.
+    """
+
+    def __init__(self, mapping_index):
+        self.mapping_index = mapping_index
+        self.hits = collections.Counter()
+        self.shadowed = collections.Counter()
+        self.seconds = collections.defaultdict(float)
+
+    def record(self, desc):
+        matched = []
+        for index, mapping in enumerate(self.mapping_index.mappings):
+            start = time.perf_counter()
+            if isinstance(mapping.pattern, str):
+                match = mapping.pattern == desc
+            else:
+                match = mapping.pattern.match(desc)
+            self.seconds[index] += time.perf_counter() - start
+            if match:
+                matched.append(index)
+        if matched:
+            self.hits[matched[-1]] += 1
+            for index in matched[:-1]:
+                self.shadowed[index] += 1
+
+    def rules(self):
+        """Return the counters of each mapping, in mapping file order."""
+        rules = []
+        for index, mapping in enumerate(self.mapping_index.mappings):
+            pattern = mapping.pattern
+            if not isinstance(pattern, str):
+                pattern = '/{0}/'.format(pattern.pattern)
+            rules.append({
+                'index': index, 'pattern': pattern, 'payee': mapping.payee,
+                'account': mapping.account, 'hits': self.hits[index],
+                'shadowed': self.shadowed[index],
+                'seconds': self.seconds[index]})
+        return rules
+
+
+class LedgerWriter:
+    """
+    Writes ledger transactions to the output file, through a buffer which
+    is written out when it holds buffer_size characters, when a write comes
+    flush_interval seconds after it was last written out, when flushed and
+    when the writer is closed. A durable writer flushes each transaction.
+    """
+
+    def __init__(self, out_file, buffer_size=1 << 20, flush_interval=0,
+                 durable=False):
+        self.out_file = out_file
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.durable = durable
+        self._buffer = []
+        self._buffered = 0
+        self._flushed_at = time.monotonic()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, text):
+        self._buffer.append(text)
+        self._buffered += len(text)
+        if (self.durable or self._buffered >= self.buffer_size or
+                (self.flush_interval and
+                 time.monotonic() - self._flushed_at >= self.flush_interval)):
+            self.flush()
+
+    def flush(self):
+        """Write out the buffer and flush the output file."""
+        if self._buffer:
+            self.out_file.write(''.join(self._buffer))
+            self._buffer.clear()
+            self._buffered = 0
+        self.out_file.flush()
+        self._flushed_at = time.monotonic()
+
+    def close(self):
+        """Flush, leaving the output file open, as it may be stdout."""
+        self.flush()
+
+
+# An md5sum, as written by any template into a transfer file
+MD5SUM_TOKEN_REGEX = re.compile(r'[0-9a-f]{32}')
+
+
+class TransferFiles:
+    """
+    Appends transfer transactions to the files named by the file= column
+    of mappings. Each file is read once, and written through one open
+    handle, flushed after each transaction if durable. A transaction is
+    in a file if its md5sum appears anywhere in it, whatever the template
+    which wrote it.
+    """
+
+    def __init__(self, durable=False):
+        self.durable = durable
+        self._files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _open(self, path):
+        key = os.path.abspath(path)
+        if key not in self._files:
+            try:
+                with open(path, encoding='utf-8') as f:
+                    md5sums = set(MD5SUM_TOKEN_REGEX.findall(f.read()))
+            except FileNotFoundError:
+                md5sums = set()
+            out_file = open(path, 'a', encoding='utf-8')
+            self._files[key] = (out_file, md5sums)
+        return self._files[key]
+
+    def contains(self, path, md5sum):
+        """Whether the transfer file at path holds md5sum."""
+        _, md5sums = self._open(path)
+        return md5sum in md5sums
+
+    def write(self, path, md5sum, text):
+        """Append the transaction text with md5sum to the file at path."""
+        out_file, md5sums = self._open(path)
+        out_file.write(text)
+        out_file.write('\n')
+        if md5sum in text:
+            md5sums.add(md5sum)
+        if self.durable:
+            out_file.flush()
+
+    def close(self):
+        for out_file, _ in self._files.values():
+            out_file.close()
+        self._files.clear()
+
+
+@contextlib.contextmanager
+def atomic_file(path, newline=None):
+    """
+    Open a temporary file next to path for writing, and atomically
+    replace path with it, once written to disk, when the block ends: path
+    is never left half written. The temporary file is dropped if the
+    block raises, except on KeyboardInterrupt, where what was written so
+    far replaces path, as it would without atomic_file.
+    """
+    directory, name = os.path.split(os.path.abspath(path))
+    # default buffering: writers such as LedgerWriter batch their writes
+    tmp_file = tempfile.NamedTemporaryFile(
+        'w', encoding='utf-8', newline=newline,
+        dir=directory, prefix='.{0}.'.format(name), suffix='.tmp',
+        delete=False)
+    committed = False
+    try:
+        try:
+            yield tmp_file
+        except KeyboardInterrupt:
+            _replace_with(tmp_file, path)
+            committed = True
+            raise
+        _replace_with(tmp_file, path)
+        committed = True
+    finally:
+        if not committed:
+            tmp_file.close()
+            os.unlink(tmp_file.name)
+
+
+def _replace_with(tmp_file, path):
+    """Sync and close tmp_file, then rename it over path."""
+    tmp_file.flush()
+    os.fsync(tmp_file.fileno())
+    tmp_file.close()
+    try:
+        mode = os.stat(path).st_mode
+    except FileNotFoundError:
+        umask = os.umask(0)
+        os.umask(umask)
+        mode = 0o666 & ~umask
+    os.chmod(tmp_file.name, mode & 0o7777)
+    os.replace(tmp_file.name, path)
+    if os.name == 'posix':
+        # make the rename itself durable
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class PreparedEntry:
+    """
+    An Entry converted by a batch worker process: the mapping winning on
+    its description, if any, and, when the template does not use
+    transaction_index, its transactions rendered for that mapping. Other
+    transactions are rendered by the Entry, built again once bound to the
+    options, template and plan of the main process.
+    """
+
+    def __init__(self, entry, mapping, journal=None, transfer=None):
+        self.fields = entry.fields
+        self.raw_csv = entry.raw_csv
+        self.desc = entry.desc
+        self.md5sum = entry.md5sum
+        self._prompt = entry.prompt()
+        self.mapping = mapping
+        self.journal = journal
+        self.transfer = transfer
+        self._entry_args = None
+        self._entry = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_entry_args'] = state['_entry'] = None
+        return state
+
+    def bind(self, options, template, plan):
+        self._entry_args = (options, template, plan)
+        return self
+
+    def entry(self):
+        if self._entry is None:
+            self._entry = Entry(self.fields, self.raw_csv, *self._entry_args)
+        return self._entry
+
+    def _prepared(self, payee, account, tags):
+        return (self.mapping is not None and
+                (payee, account) == self.mapping[:2] and
+                tags is self.mapping[2])
+
+    def prompt(self):
+        return self._prompt
+
+    def journal_entry(self, transaction_index, payee, debit_account, tags):
+        if self.journal is not None and self._prepared(payee, debit_account, tags):
+            return self.journal
+        return self.entry().journal_entry(transaction_index, payee,
+                                          debit_account, tags)
+
+    def transfer_entry(self, transaction_index, payee, account, transfer_to, tags):
+        if self.transfer is not None and self._prepared(payee, account, tags):
+            return self.transfer
+        return self.entry().transfer_entry(transaction_index, payee, account,
+                                           transfer_to, tags)
+
+
+def prepare_entries(entries, template, mapping_index):
+    """
+    Return the PreparedEntry of each Entry of entries.
+    """
+    render = 'transaction_index' not in template.fields
+    prepared = []
+    for entry in entries:
+        mapping = map_entry(entry.desc, mapping_index)
+        journal = transfer = None
+        if mapping is not None and render:
+            payee, account, tags, transfer_to, _ = mapping
+            journal = entry.journal_entry(0, payee, account, tags)
+            if transfer_to is not None:
+                transfer = entry.transfer_entry(0, payee, account,
+                                                transfer_to, tags)
+        prepared.append(PreparedEntry(entry, mapping, journal, transfer))
+    return prepared
+
+
+# Number of records prepared at once by a worker of the --quiet pipeline
+PIPELINE_CHUNK_SIZE = 1000
+
+_worker = None
+
+
+def _init_worker(options, mapping_index):
+    global _worker
+    template = TransactionTemplate.from_file(options.template_file,
+                                             template_addons(options))
+    _worker = (options, template, ColumnPlan(options), mapping_index)
+
+
+def _prepare_batch_file(path):
+    options, template, plan, mapping_index = _worker
+    stats = RunStats(enabled=False)
+    with open(path, newline='', encoding=options.encoding) as in_file:
+        records = stats.count_records(read_records(in_file, options))
+        entries = csv_entries(records, options, template, plan)
+        return prepare_entries(entries, template, mapping_index), stats.counts
+
+
+def _prepare_records(records):
+    options, template, plan, mapping_index = _worker
+    return prepare_entries(csv_entries(records, options, template, plan),
+                           template, mapping_index)
+
+
+def chunked(iterable, size):
+    """Yield lists of size items of iterable, the last one being shorter."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def map_ordered(executor, fn, items, window):
+    """
+    Yield fn(item) for each of items, in order, computed by executor with
+    at most window items submitted ahead of the one being yielded.
+    """
+    pending = collections.deque()
+    try:
+        for item in items:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def batch_files(patterns, output_dir=''):
+    """
+    Return (input path, output path) for each file matching the glob
+    patterns, in the order of the patterns, and sorted for each pattern.
+    The output path is the input path with a .ledger extension, in
+    output_dir if given.
+    """
+    files = []
+    outputs = {}
+    for pattern in patterns:
+        paths = sorted(glob.glob(os.path.expanduser(pattern)))
+        if not paths:
+            print('No file matches {0}'.format(pattern), file=sys.stderr)
+            sys.exit(1)
+        for path in paths:
+            if os.path.abspath(path) in outputs.values():
+                continue
+            directory, name = os.path.split(path)
+            out_path = os.path.join(output_dir or directory,
+                                    os.path.splitext(name)[0] + '.ledger')
+            if out_path in outputs:
+                print('Files {0} and {1} would both be converted to {2}'
+                      .format(outputs[out_path], path, out_path),
+                      file=sys.stderr)
+                sys.exit(1)
+            outputs[out_path] = os.path.abspath(path)
+            files.append((path, out_path))
+    return files
+
+
+def load_stage_hooks(specs):
+    """
+    Return the functions named by specs, as MODULE:FUNCTION, where
+    MODULE is the name of a module to import or the path of a python
+    file.
+    """
+    hooks = []
+    for spec in specs or ():
+        module_name, _, function = spec.rpartition(':')
+        try:
+            if module_name.endswith('.py'):
+                name = os.path.splitext(os.path.basename(module_name))[0]
+                module_spec = importlib.util.spec_from_file_location(
+                    name, module_name)
+                module = importlib.util.module_from_spec(module_spec)
+                module_spec.loader.exec_module(module)
+            else:
+                module = importlib.import_module(module_name)
+            hooks.append(getattr(module, function))
+        except (ImportError, OSError, AttributeError, ValueError) as e:
+            print('Can not load stage hook {0}: {1}'.format(spec, e),
+                  file=sys.stderr)
+            sys.exit(1)
+    return hooks
+
+
+@contextlib.contextmanager
+def profiling(options):
+    """
+    Profile the run with cProfile when options.profile is set, and trace
+    memory allocations with tracemalloc when options.trace_memory is set,
+    writing the results to the named files, or to stderr for '-'.
+    """
+    profiler = None
+    if options.profile:
+        profiler = cProfile.Profile()
+    if options.trace_memory:
+        tracemalloc.start()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            if options.profile == '-':
+                pstats.Stats(profiler, stream=sys.stderr) \
+                    .sort_stats('cumulative').print_stats(30)
+            else:
+                profiler.dump_stats(options.profile)
+        if options.trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            lines = ['peak: {0:.1f} KiB'.format(peak / 1024)]
+            lines.extend(str(stat) for stat in
+                         snapshot.statistics('lineno')[:30])
+            if options.trace_memory == '-':
+                print('\n'.join(lines), file=sys.stderr)
+            else:
+                with open(options.trace_memory, 'w', encoding='utf-8') as f:
+                    f.write('\n'.join(lines) + '\n')
+
+
+def _call(function, *args):
+    """Return function(*args), as a step which RunStats can time."""
+    return function(*args)
+
+
 def reset_stdin():
     """ If file input is stdin, then stdin must be reset to be able
     to use readline. How to reset stdin in explained in below URLs.
@@ -842,35 +2752,318 @@ def reset_stdin():
         sys.exit(1)
 
 
-def main(options):
+def run_sections(options):
+    """
+    Convert the input_files of the config file sections named by
+    options.sections, or of all sections with input_files, one after the
+    other. Files read for one section are not read again for the next
+    ones, which share duplicate detection and mappings.
+    """
+    if not options.config_file:
+        print('sections can only be used with a config file.',
+              file=sys.stderr)
+        sys.exit(1)
+    config = configparser.RawConfigParser(DEFAULTS)
+    config.read(options.config_file)
+    names = options.sections or [
+        name for name in config.sections()
+        if config.get(name, 'input_files').strip()]
+
+    shared = {}
+    stats = RunStats(options.stats or options.stats_file,
+                     load_stage_hooks(options.stage_hook))
+    for name in names:
+        section_options = parse_args_and_config_file(name, options.config_file)
+        section_options.batch = shlex.split(section_options.input_files)
+        if not section_options.batch:
+            print('Section {0} in config file {1} has no input_files'
+                  .format(name, options.config_file),
+                  file=sys.stderr)
+            sys.exit(1)
+        main(section_options, shared, stats)
+    if options.stats or options.stats_file:
+        stats.write(options.stats_file)
+    if options.mapping_report or options.mapping_report_file:
+        stats.write_mapping_report(options.mapping_report_file)
+
+
+def file_signature(paths):
+    """Return the modification time and size of each of paths, or None
+    for the missing ones."""
+    signature = {}
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature[path] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            signature[path] = None
+    return signature
 
-    # Define responses to yes/no prompts
-    possible_yesno = {'Y', 'N'}
 
-    # Get list of accounts and payees from Ledger specified file
-    possible_accounts = set([])
-    possible_payees = set([])
-    possible_tags = set([])
-    md5sum_hashes = set()
-    csv_comments = set()
-    if options.ledger_file:
-        possible_accounts = accounts_from_ledger(options.ledger_file, options.ledger_binary)
-        possible_payees = payees_from_ledger(options.ledger_file, options.ledger_binary)
-        csv_comments, md5sum_hashes = csv_md5sum_from_ledger(options.ledger_file)
+class ConversionService:
+    """
+    Conversions of CSV text sent to the server, with the journal,
+    mappings and accounts kept in memory between requests. Before each
+    conversion, the files which changed size or modification time since
+    they were read are read again: the journal incrementally, through
+    its JournalCache, and also when its include patterns match other
+    files.
+    """
 
-    # Read mappings
-    mappings = []
-    if options.mapping_file:
-        mappings = read_mapping_file(options.mapping_file)
+    # Options of the conversions of the server: nobody to ask, output
+    # sent back, and no processes, mapping file rewrites or reports for
+    # each request
+    CONVERSION_OPTIONS = {
+        'quiet': True, 'unattended': True, 'confirm_dupes': False,
+        'entry_review': False, 'prompt_add_mappings': False,
+        'clear_screen': False, 'atomic': False, 'incremental': False,
+        'batch': None, 'jobs': 1, 'compact_mappings': False,
+        'stats': False, 'stats_file': '', 'mapping_report': False,
+        'mapping_report_file': '', 'stage_hook': None}
+
+    def __init__(self, options):
+        self.options = options
+        self.shared = {}
+        # {(kind, path): {file path: signature when read}}
+        self.signatures = {}
+        # {(kind, path): {include pattern: sorted matches when read}}
+        self.globs = {}
+        self.sections = {}
+        self.config_signature = None
+
+    def section_options(self, section=None):
+        """Return the options of the config file section, or of the
+        server if None."""
+        if self.options.config_file:
+            signature = file_signature([self.options.config_file])
+            if signature != self.config_signature:
+                self.sections.clear()
+                self.config_signature = signature
+        if section not in self.sections:
+            if section is None:
+                options = self.options
+            else:
+                options = parse_args_and_config_file(
+                    section, self.options.config_file)
+            options = argparse.Namespace(**vars(options))
+            for name, value in self.CONVERSION_OPTIONS.items():
+                setattr(options, name, value)
+            self.sections[section] = options
+        return self.sections[section]
+
+    def load(self, options):
+        """Read the files of options which were not read yet, or changed
+        since."""
+        read = {}
+        for kind, path in (('ledger', options.ledger_file),
+                           ('mapping', options.mapping_file),
+                           ('accounts', options.accounts_file)):
+            if not path:
+                continue
+            source = (kind, os.path.abspath(path))
+            signature = file_signature(
+                self.signatures.get(source, [source[1]]))
+            if (signature != self.signatures.get(source) or
+                    any(sorted(glob.glob(pattern)) != matches
+                        for pattern, matches in
+                        self.globs.get(source, {}).items())):
+                self.shared.pop(source, None)
+                # taken before reading, so that changes made while the
+                # file is read are seen by the next request
+                read[source] = signature
+        read_startup_data(options, self.shared)
+        for (kind, path), signature in read.items():
+            paths = [path]
+            globs = {}
+            if kind == 'ledger':
+                journal_cache = self.shared[journal_cache_key(options)]
+                paths = [found_path for found_path, _ in
+                         journal_files(path, journal_cache, globs,
+                                       vocabulary=False)]
+            self.globs[(kind, path)] = {
+                pattern: sorted(matches) for pattern, matches in globs.items()}
+            current = file_signature(paths)
+            self.signatures[(kind, path)] = {
+                p: signature.get(p, current[p]) for p in paths}
+
+    def convert(self, request):
+        """
+        Return the response to request, a dict with the 'csv' text to
+        convert and the config file 'section' to use, if any: a dict
+        with the converted 'ledger' text, or the 'error' message.
+        """
+        errors = io.StringIO()
+        try:
+            # the messages of failed conversions are sent to the client
+            with contextlib.redirect_stderr(errors), \
+                    contextlib.redirect_stdout(io.StringIO()):
+                options = self.section_options(request.get('section'))
+                self.load(options)
+                # duplicates are detected within each request, as for
+                # separate runs
+                shared = {}
+                for key, loaded in self.shared.items():
+                    if isinstance(loaded, dict) and 'md5sum_hashes' in loaded:
+                        loaded = dict(loaded, md5sum_hashes=set(
+                            loaded['md5sum_hashes']))
+                    shared[key] = loaded
+                options = argparse.Namespace(**vars(options))
+                options.infile = io.StringIO(request['csv'], newline='')
+                options.infile.name = '<socket>'
+                options.outfile = io.StringIO()
+                main(options, shared)
+        except (Exception, SystemExit) as e:
+            return {'error': errors.getvalue().strip() or str(e) or
+                    type(e).__name__}
+        return {'ledger': options.outfile.getvalue()}
+
+
+class ConversionHandler(socketserver.StreamRequestHandler):
+    """Answer each JSON line sent by a client with a JSON line."""
+
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line)
+                if (not isinstance(request, dict) or
+                        not isinstance(request.get('csv'), str)):
+                    raise ValueError('expected an object with a csv string')
+                response = self.server.service.convert(request)
+            except ValueError as e:
+                response = {'error': 'Invalid request: {0}'.format(e)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+def serve(options):
+    """
+    Convert the CSV text sent by clients on the unix socket
+    options.serve, one request after the other, until interrupted.
+    """
+    if not hasattr(socket, 'AF_UNIX'):
+        print('serve needs unix sockets, which this system lacks.',
+              file=sys.stderr)
+        sys.exit(1)
+    if os.path.exists(options.serve):
+        try:
+            with socket.socket(socket.AF_UNIX) as probe:
+                probe.connect(options.serve)
+        except OSError:
+            # left over by a server which did not stop cleanly
+            os.unlink(options.serve)
+        else:
+            print('A server is already listening on {0}'
+                  .format(options.serve),
+                  file=sys.stderr)
+            sys.exit(1)
+
+    service = ConversionService(options)
+    # read the files before the first request
+    service.load(service.section_options())
+    server = socketserver.UnixStreamServer(options.serve, ConversionHandler)
+    server.service = service
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print()
+    finally:
+        server.server_close()
+        os.unlink(options.serve)
+
+
+def run_client(options):
+    """
+    Convert options.infile with the server listening on options.client,
+    and write the ledger transactions to options.outfile.
+    """
+    request = {'csv': options.infile.read()}
+    if options.section is not None:
+        request['section'] = options.section
+    try:
+        with socket.socket(socket.AF_UNIX) as client:
+            client.connect(options.client)
+            client.sendall(json.dumps(request).encode('utf-8') + b'\n')
+            with client.makefile('rb') as f:
+                response = json.loads(f.readline() or 'null')
+    except (OSError, ValueError) as e:
+        print('Can not convert with the server on {0}: {1}'
+              .format(options.client, e),
+              file=sys.stderr)
+        sys.exit(1)
+    if not isinstance(response, dict) or 'ledger' not in response:
+        error = response.get('error') if isinstance(response, dict) else None
+        print(error or 'No response from the server on {0}'
+              .format(options.client),
+              file=sys.stderr)
+        sys.exit(1)
+    if not options.incremental:
+        options.outfile.truncate(0)
+    options.outfile.write(response['ledger'])
 
-    if options.accounts_file:
-        possible_accounts.update(read_accounts_file(options.accounts_file))
 
-    # Add to possible values the ones from mappings
-    for m in mappings:
-        possible_payees.add(m.payee)
-        possible_accounts.add(m.account)
-        possible_tags.update(set(m.tags))
+def main(options, shared=None, stats=None):
+
+    # Define responses to yes/no prompts
+    possible_yesno = {'Y', 'N'}
+
+    # Report the stats of this run, unless they are part of a larger one
+    report_stats = stats is None and (options.stats or options.stats_file)
+    report_mappings = stats is None and (options.mapping_report or
+                                         options.mapping_report_file)
+    if stats is None:
+        stats = RunStats(options.stats or options.stats_file,
+                         load_stage_hooks(options.stage_hook))
+    # Load the template before anything else, so errors show up early
+    try:
+        template = TransactionTemplate.from_file(options.template_file,
+                                                 template_addons(options))
+    except ValueError as e:
+        print('Invalid template file {0}: {1}'
+              .format(options.template_file, e),
+              file=sys.stderr)
+        sys.exit(1)
+    plan = ColumnPlan(options)
+
+    # Get list of accounts and payees from Ledger specified file,
+    # mappings and accounts file
+    with stats.phase('startup'):
+        startup = read_startup_data(options, shared, stats)
+    possible_accounts = CompletionIndex(sorted(startup.accounts))
+    possible_payees = CompletionIndex(sorted(startup.payees))
+    possible_tags = CompletionIndex(sorted(startup.tags))
+    md5sum_hashes = startup.md5sum_hashes
+    csv_comments = startup.csv_comments
+    mapping_index = startup.mapping_index
+    mapping_profile = None
+    if options.mapping_report or options.mapping_report_file:
+        mapping_profile = stats.mapping_profile(options.mapping_file or '',
+                                                mapping_index)
+    mapping_writer = MappingWriter(options.mapping_file,
+                                   options.mapping_flush_interval,
+                                   options.compact_mappings)
+    # The flush intervals are checked as rows are written: whatever is
+    # buffered is written before each prompt, so it never waits on the user
+    flushes = [stats.timed('write', mapping_writer.flush)]
+
+    def flushed(ask):
+        def ask_flushed(*args):
+            for flush in flushes:
+                flush()
+            return ask(*args)
+        return ask_flushed
+
+    # time spent waiting on the user is kept apart from compute time
+    ask_value = flushed(stats.timed('input', prompt_for_value))
+    ask_tags = flushed(stats.timed('input', prompt_for_tags))
+    # Without prompts for mapped entries, entries can be prepared on a
+    # process pool, which only pays off with more than one process
+    jobs = options.jobs or os.cpu_count() or 1
+    parallel = options.quiet and not options.entry_review and jobs > 1
+    # Without --stats, rows are neither timed nor counted: the timed
+    # steps are then the functions themselves
+    counting = stats.enabled
+    match = stats.timed('match', map_entry)
+    is_duplicate = stats.timed('dedupe', md5sum_hashes.__contains__)
+    render = stats.timed('render', _call)
 
     def get_payee_and_account(entry):
         payee = entry.desc
@@ -879,60 +3072,53 @@ def main(options):
         transfer_to = None
         transfer_to_file = None
         found = False
-        # Try to match entry desc with mappings patterns
-        for m in mappings:
-            pattern = m.pattern
-            if isinstance(pattern, str):
-                if entry.desc == pattern:
-                    payee, account, tags = m.payee, m.account, m.tags
-                    transfer_to, transfer_to_file = m.transfer_to, m.transfer_to_file
-                    found = True  # do not break here, later mapping must win
-            else:
-                # If the pattern isn't a string it's a regex
-                match = m.pattern.match(entry.desc)
-                if match:
-                #if m[0].match(entry.desc):
-                    payee = m.payee
-                    # perform regexp substitution if captures were used
-                    if match.groups():
-                        payee = m.pattern.sub(m.payee, entry.desc)
-                    account, tags = m.account, m.tags
-                    transfer_to, transfer_to_file = m.transfer_to, m.transfer_to_file
-                    found = True
+        # Try to match entry desc with mappings patterns, unless a batch
+        # worker already found the mapping
+        mapped = getattr(entry, 'mapping', None)
+        if mapped is None:
+            mapped = match(entry.desc, mapping_index)
+        if mapped is not None:
+            payee, account, tags, transfer_to, transfer_to_file = mapped
+            found = True
+        if counting:
+            stats.counts['hits' if found else 'misses'] += 1
+        if mapping_profile is not None:
+            mapping_profile.record(entry.desc)
 
         modified = False
-        if options.quiet and found:
+        if (options.quiet and found) or options.unattended:
             pass
         else:
             #if options.clear_screen:
             #    print('\033[2J\033[;H')
             #print('\n' + entry.prompt())
-            value = prompt_for_value('Payee', possible_payees, payee)
+            value = ask_value('Payee', possible_payees, payee)
             if value:
                 modified = modified if modified else value != payee
                 payee = value
-            value = prompt_for_value('Account', possible_accounts, account)
+            value = ask_value('Account', possible_accounts, account)
             if value:
                 modified = modified if modified else value != account
                 account = value
             if options.tags:
-                value = prompt_for_tags('Tag', possible_tags, tags)
+                value = ask_tags('Tag', possible_tags, tags)
                 if value:
                     modified = modified if modified else value != tags
                     tags = value
 
-        if not found or (found and modified):
+        if (not found and not options.unattended) or (found and modified):
             value = 'Y'
             # if prompt-add-mappings option passed then request confirmation before adding to mapping file
             if options.prompt_add_mappings:
-                yn_response = prompt_for_value('Append to mapping file?', possible_yesno, 'Y')
+                yn_response = ask_value('Append to mapping file?', possible_yesno, 'Y')
                 if yn_response:
                     value = yn_response
             if value.upper().strip() not in ('N', 'NO'):
                 # Add new or changed mapping to mappings and append to file
-                mappings.append(MappingInfo(entry.desc, payee, account, tags, None, None))
-                append_mapping_file(options.mapping_file,
-                                entry.desc, payee, account, tags)
+                mapping_index.append(MappingInfo(entry.desc, payee, account, tags, None, None))
+                mapping_writer.append(entry.desc, payee, account, tags)
+                if counting:
+                    stats.counts['learned'] += 1
 
             # Add new possible_values to possible values lists
             possible_payees.add(payee)
@@ -945,115 +3131,191 @@ def main(options):
         Process them.
         Write Ledger lines either to filename or stdout.
         """
-        if not options.incremental:
-            out_file.truncate(0)
-
-        csv_lines = get_csv_lines(in_file)
+        records = stats.timed_iter(
+            'read', stats.count_records(read_records(in_file, options)))
         if in_file.name == '<stdin>':
             reset_stdin()
-        for line in  process_csv_lines(csv_lines):
-            print(line, sep='\n', file=out_file)
-            out_file.flush()
-
-    def get_csv_lines(in_file):
+        if not parallel:
+            write_output(csv_entries(records, options, template, plan),
+                         out_file)
+            return
+
+        # Entries are parsed, mapped and rendered by chunks on worker
+        # processes, once there is more than one chunk
+        if options.date_sorted:
+            # stop reading at the first old record, as serial runs do
+            records = filter_records(records, options, plan)
+        chunks = chunked(records, PIPELINE_CHUNK_SIZE)
+        first = next(chunks, [])
+        if len(first) < PIPELINE_CHUNK_SIZE:
+            write_output(csv_entries(first, options, template, plan),
+                         out_file)
+            return
+        with worker_pool() as executor:
+            prepared = map_ordered(executor, _prepare_records,
+                                   itertools.chain([first], chunks),
+                                   2 * jobs)
+            write_output((entry.bind(options, template, plan)
+                          for entries in prepared for entry in entries),
+                         out_file)
+
+    def process_batch(files):
+        """ Convert each (input path, output path) of files, on a
+        process pool with --quiet.
         """
-        Return csv lines from the in_file adjusted
-        for the skip_lines and reverse options.
+        if not parallel or len(files) == 1:
+            for in_path, out_path in files:
+                with open(in_path, newline='', encoding=options.encoding) as in_file, \
+                        open(out_path, 'a', encoding='utf-8') as out_file:
+                    process_input_output(in_file, out_file)
+            return
+
+        with worker_pool() as executor:
+            prepared = executor.map(_prepare_batch_file,
+                                    [in_path for in_path, _ in files])
+            for (in_path, out_path), (entries, counts) in zip(files, prepared):
+                stats.counts.update(counts)
+                with open(out_path, 'a', encoding='utf-8') as out_file:
+                    write_output((entry.bind(options, template, plan)
+                                  for entry in entries), out_file)
+
+    def worker_pool():
+        """ Return a process pool preparing entries with the options and
+        mappings of this run.
+        """
+        worker_options = argparse.Namespace(**{
+            k: v for k, v in vars(options).items()
+            if k not in ('infile', 'outfile')})
+        return concurrent.futures.ProcessPoolExecutor(
+            jobs, initializer=_init_worker,
+            initargs=(worker_options, mapping_index))
+
+    def write_output(entries, out_file):
+        """ Write the ledger transactions of entries to out_file.
+        """
+        atomic = options.atomic and not options.incremental
+        if atomic:
+            output = atomic_file(out_file.name)
+        else:
+            if not options.incremental:
+                out_file.truncate(0)
+            output = contextlib.nullcontext(out_file)
+
+        # Interactive and incremental runs see each transaction written
+        # as soon as it is committed
+        durable = not atomic and (options.incremental or not options.quiet)
+        with output as target, \
+                LedgerWriter(target, options.output_buffer_size,
+                             options.flush_interval, durable) as writer, \
+                TransferFiles(durable) as transfer_files:
+            entries = stats.timed_iter('parse', entries)
+            write = stats.timed('write', writer.write)
+            flush = stats.timed('write', writer.flush)
+            flushes.append(flush)
+            try:
+                for line in process_entries(entries, transfer_files):
+                    write(line + '\n')
+            finally:
+                flushes.remove(flush)
+            flush()
+
+    def process_entries(entries, transfer_files):
+        """ Yield the ledger transactions of entries.
         """
-        csv_lines = in_file.readlines()
-        csv_lines = csv_lines[options.skip_lines:]
-        if options.reverse:
-            csv_lines = list(reversed(csv_lines))
-        return csv_lines
-
-    def process_csv_lines(csv_lines):
-        dialect = None
-        try:
-            dialect = csv.Sniffer().sniff(
-                    "".join(csv_lines[:3]), options.delimiter)
-        except csv.Error:  # can't guess specific dialect, try without one
-            pass
-
-        bank_reader = csv.reader(csv_lines, dialect)
         transaction_index = 0
-        for i, row in enumerate(bank_reader):
-            # Skip any empty lines in the input
-            if len(row) == 0:
-                continue
-
-            entry = Entry(row, csv_lines[i],
-                          options)
-
+        write_transfer = stats.timed('write', transfer_files.write)
+        for entry in entries:
+            if counting:
+                stats.counts['entries'] += 1
             # detect duplicate entries in the ledger file and optionally skip or prompt user for action
-            # if options.skip_dupes and csv_lines[i].strip() in csv_comments:
-            if (options.skip_older_than < 0) or (entry.days_old <= options.skip_older_than):
+            # if options.skip_dupes and raw_csv.strip() in csv_comments:
+            if not options.unattended:
                 if options.clear_screen:
                     print('\033[2J\033[;H')
                 print('\n' + entry.prompt())
-                if (options.skip_dupes or options.confirm_dupes) and entry.md5sum in md5sum_hashes:
-                    value = 'Y'
-                    # if interactive flag was passed prompt user before skipping transaction
-                    if options.confirm_dupes:
-                        yn_response = prompt_for_value('Duplicate transaction detected, skip?', possible_yesno, 'Y')
-                        if yn_response:
-                            value = yn_response
-                    if value.upper().strip() not in ('N', 'NO'):
-                        continue
-                while True:
-                    payee, account, tags, transfer_to, transfer_to_file = get_payee_and_account(entry)
-                    value = 'C'
-                    if options.entry_review:
-                        # need to display ledger formatted entry here
-                        #
-                        # request confirmation before committing transaction
-                        print('\n' + 'Ledger Entry:')
-                        print(entry.journal_entry(transaction_index + 1, payee, account, tags))
-                        yn_response = prompt_for_value('Commit transaction (Commit, Modify, Skip)?', ('C', 'M', 'S'),
-                                                       value)
-                        if yn_response:
-                            value = yn_response
-                    if value.upper().strip() not in ('C', 'COMMIT'):
-                        if value.upper().strip() in ('S', 'SKIP'):
-                            break
-                        else:
-                            continue
-                    else:
-                        # add md5sum of new entry, this helps detect duplicate entries in same file
-                        md5sum_hashes.add(entry.md5sum)
-                        break
-                if value.upper().strip() in ('S', 'SKIP'):
+            duplicate = is_duplicate(entry.md5sum)
+            if (options.skip_dupes or options.confirm_dupes) and duplicate:
+                value = 'Y'
+                # if interactive flag was passed prompt user before skipping transaction
+                if options.confirm_dupes:
+                    yn_response = ask_value('Duplicate transaction detected, skip?', possible_yesno, 'Y')
+                    if yn_response:
+                        value = yn_response
+                if value.upper().strip() not in ('N', 'NO'):
+                    if counting:
+                        stats.counts['duplicates'] += 1
                     continue
+            while True:
+                payee, account, tags, transfer_to, transfer_to_file = get_payee_and_account(entry)
+                value = 'C'
+                if options.entry_review:
+                    # need to display ledger formatted entry here
+                    #
+                    # request confirmation before committing transaction
+                    print('\n' + 'Ledger Entry:')
+                    print(entry.journal_entry(transaction_index + 1, payee, account, tags))
+                    yn_response = ask_value('Commit transaction (Commit, Modify, Skip)?', ('C', 'M', 'S'),
+                                            value)
+                    if yn_response:
+                        value = yn_response
+                if value.upper().strip() not in ('C', 'COMMIT'):
+                    if value.upper().strip() in ('S', 'SKIP'):
+                        break
+                    else:
+                        continue
+                else:
+                    # add md5sum of new entry, this helps detect duplicate entries in same file
+                    md5sum_hashes.add(entry.md5sum)
+                    break
+            if value.upper().strip() in ('S', 'SKIP'):
+                if counting:
+                    stats.counts['skipped'] += 1
+                continue
 
-                transaction_index += 1
-                yield entry.journal_entry(transaction_index, payee, account, tags)
+            if counting:
+                stats.counts['converted'] += 1
+            transaction_index += 1
+            yield render(entry.journal_entry, transaction_index, payee, account, tags)
 
-                if transfer_to is not None:
-                    transaction_index += 1
-                    transfer_entry = entry.transfer_entry(transaction_index, payee, account, transfer_to, tags)
-                    if transfer_to_file is None:
-                        yield transfer_entry
-                    else:
-                        with open(transfer_to_file, "rb") as f:
-                            if f.read(1):
-                                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as s:
-                                    has_entry = s.find(bytes(entry.md5sum, 'utf-8')) != -1
-                            else:
-                                has_entry = False
-
-                        if not has_entry or not options.skip_dupes:
-                            with open(transfer_to_file, "a") as f:
-                                f.write(transfer_entry)
-                                f.write("\n")
+            if transfer_to is not None:
+                transaction_index += 1
+                transfer_entry = render(entry.transfer_entry, transaction_index, payee, account, transfer_to, tags)
+                if transfer_to_file is None:
+                    yield transfer_entry
+                elif not (options.skip_dupes and
+                          transfer_files.contains(transfer_to_file, entry.md5sum)):
+                    write_transfer(transfer_to_file, entry.md5sum,
+                                   transfer_entry)
 
     try:
-        process_input_output(options.infile, options.outfile)
+        with mapping_writer:
+            if options.batch:
+                process_batch(batch_files(options.batch, options.output_dir))
+            else:
+                process_input_output(options.infile, options.outfile)
     except KeyboardInterrupt:
         print()
+        if report_stats:
+            stats.write(options.stats_file)
+        if report_mappings:
+            stats.write_mapping_report(options.mapping_report_file)
         sys.exit(0)
+    if report_stats:
+        stats.write(options.stats_file)
+    if report_mappings:
+        stats.write_mapping_report(options.mapping_report_file)
 
 
 if __name__ == "__main__":
     options = parse_args_and_config_file()
-    main(options)
+    with profiling(options):
+        if options.serve:
+            serve(options)
+        elif options.client:
+            run_client(options)
+        elif options.sections is not None:
+            run_sections(options)
+        else:
+            main(options)
 
 # vim: ts=4 sw=4 et
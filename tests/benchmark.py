@@ -0,0 +1,331 @@
+#!/usr/bin/env python3
+"""Benchmark icsv2ledger on synthetic bank exports.
+
+Generates a CSV export, a mapping file and a journal with included
+files, then times the startup, parse, match, render and write phases,
+and whole runs of main() with the default options and on a process pool
+as with --jobs. Results can be saved as baselines, and are
+compared to them on later runs, so that a change making conversion
+slower shows up. Without a baseline saved on this machine, results are
+compared to the reference baselines kept with the sources, scaled by
+the time of a fixed workload, which is only advisory.
+
+    python benchmark.py --scenario small --save-baseline
+    python benchmark.py --scenario small
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from icsv2ledger import (ColumnPlan, Entry, LedgerWriter, TransactionTemplate,  # noqa: E402
+                         csv_entries, main, map_entry, parse_args_and_config_file,
+                         read_records, read_startup_data, template_addons)
+
+SCENARIOS = {
+    'small': dict(rows=1000, mappings=200, regex_ratio=0.5, includes=2,
+                  journal_rows=2000, dupe_rate=0.1),
+    'medium': dict(rows=20000, mappings=2000, regex_ratio=0.5, includes=10,
+                   journal_rows=50000, dupe_rate=0.1),
+    'large': dict(rows=200000, mappings=10000, regex_ratio=0.3, includes=50,
+                  journal_rows=500000, dupe_rate=0.05),
+}
+
+PHASES = ('startup', 'parse', 'match', 'render', 'write', 'main', 'pool')
+
+# Processes of the 'pool' run of main(), which --jobs would start
+POOL_JOBS = max(2, os.cpu_count() or 1)
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                'benchmark_baseline.json')
+
+# Baselines of another machine, which never fail a run
+DEFAULT_REFERENCE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                 'benchmark_reference.json')
+
+
+def conversion_options(workdir, **overrides):
+    """
+    Return the default options, but for a quiet run over the files of
+    workdir, without duplicates.
+    """
+    argv = sys.argv
+    sys.argv = [argv[0]]
+    try:
+        options = parse_args_and_config_file()
+    finally:
+        sys.argv = argv
+    options.quiet = True
+    options.skip_dupes = True
+    options.native_scanner = True
+    options.csv_date_format = '%d/%m/%Y'
+    options.skip_lines = 0
+    options.ledger_file = os.path.join(workdir, 'journal.ledger')
+    options.mapping_file = os.path.join(workdir, 'mapping.txt')
+    options.accounts_file = None
+    for name, value in overrides.items():
+        setattr(options, name, value)
+    return options
+
+
+def generate(workdir, rows, mappings, regex_ratio, includes, journal_rows,
+             dupe_rate, seed=0):
+    """
+    Write export.csv, mapping.txt and journal.ledger, which includes
+    journal-N.ledger files, in workdir. Every CSV row is matched by a
+    mapping, and dupe_rate of them are already in the journal.
+    """
+    rng = random.Random(seed)
+    regex_count = int(mappings * regex_ratio)
+
+    with open(os.path.join(workdir, 'mapping.txt'), 'w', encoding='utf-8') as f:
+        for i in range(mappings):
+            if i < regex_count:
+                f.write('/^CARD [0-9]+ SHOP{0:05d} /,Shop {0},Expenses:Shop{1}\n'
+                        .format(i, i % 20))
+            else:
+                f.write('TRANSFER ACCT{0:05d},Payee {0},Expenses:Account{1}\n'
+                        .format(i, i % 20))
+
+    def row(n):
+        day = date(2019, 1, 1) + timedelta(days=n % 365)
+        i = rng.randrange(mappings)
+        if i < regex_count:
+            desc = 'CARD {0} SHOP{1:05d} CITY{2}'.format(rng.randrange(10000), i,
+                                                        rng.randrange(100))
+        else:
+            desc = 'TRANSFER ACCT{0:05d}'.format(i)
+        amount = '{0}.{1:02d}'.format(rng.randrange(1000), rng.randrange(100))
+        return [day.strftime('%d/%m/%Y'), desc, amount, '']
+
+    csv_rows = [row(n) for n in range(rows)]
+    with open(os.path.join(workdir, 'export.csv'), 'w', encoding='utf-8') as f:
+        for fields in csv_rows:
+            f.write(','.join(fields) + '\n')
+
+    # The journal holds the duplicate rows and other transactions, as
+    # converted by icsv2ledger, spread over the included files
+    options = conversion_options(workdir)
+    template = TransactionTemplate.from_file(options.template_file,
+                                             template_addons(options))
+    plan = ColumnPlan(options)
+    dupes = [fields for fields in csv_rows if rng.random() < dupe_rate]
+    others = [row(rows + n) for n in range(max(journal_rows - len(dupes), 0))]
+    journal = dupes + others
+    rng.shuffle(journal)
+    files = [open(os.path.join(workdir, 'journal-{0}.ledger'.format(n)), 'w',
+                  encoding='utf-8') for n in range(max(includes, 1))]
+    try:
+        for n, fields in enumerate(journal):
+            entry = Entry(fields, ','.join(fields), options, template, plan)
+            files[n % len(files)].write(
+                entry.journal_entry(n, entry.desc, 'Expenses:Unknown', []) + '\n')
+    finally:
+        for f in files:
+            f.close()
+    with open(os.path.join(workdir, 'journal.ledger'), 'w', encoding='utf-8') as f:
+        f.write('account Assets:Bank:Current\n\n')
+        for f_included in files:
+            f.write('include {0}\n'.format(os.path.basename(f_included.name)))
+
+
+def run_phases(workdir):
+    """Return the time in seconds of each phase, once."""
+    times = {}
+    options = conversion_options(workdir)
+    template = TransactionTemplate.from_file(options.template_file,
+                                             template_addons(options))
+    plan = ColumnPlan(options)
+
+    start = time.perf_counter()
+    startup = read_startup_data(options)
+    times['startup'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with open(os.path.join(workdir, 'export.csv'), newline='', encoding='utf-8') as f:
+        entries = list(csv_entries(read_records(f, options), options,
+                                   template, plan))
+    times['parse'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    mapped = [map_entry(entry.desc, startup.mapping_index) for entry in entries]
+    times['match'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    lines = [entry.journal_entry(n + 1, m[0], m[1], list(m[2]))
+             for n, (entry, m) in enumerate(zip(entries, mapped))]
+    times['render'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    with open(os.path.join(workdir, 'phases.ledger'), 'w', encoding='utf-8') as f, \
+            LedgerWriter(f) as writer:
+        for line in lines:
+            writer.write(line + '\n')
+    times['write'] = time.perf_counter() - start
+
+    times['main'] = run_main(workdir, options)
+    times['pool'] = run_main(workdir, conversion_options(workdir, jobs=POOL_JOBS))
+    return times
+
+
+def run_main(workdir, options):
+    """Return the time in seconds of a whole run of main() with options."""
+    out_path = os.path.join(workdir, 'main.ledger')
+    with open(os.path.join(workdir, 'export.csv'), newline='', encoding='utf-8') as infile, \
+            open(out_path, 'w', encoding='utf-8') as outfile, \
+            open(os.devnull, 'w') as devnull:
+        options.infile = infile
+        options.outfile = outfile
+        stdout = sys.stdout
+        # quiet runs still print each entry summary
+        sys.stdout = devnull
+        try:
+            start = time.perf_counter()
+            main(options)
+            return time.perf_counter() - start
+        finally:
+            sys.stdout = stdout
+
+
+def calibrate(repeat=5):
+    """
+    Return the best time of a fixed workload of the kind of conversion:
+    string formatting, regex matching and hashing.
+    """
+    regex = re.compile(r'^CARD [0-9]+ SHOP(\d+) ')
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        values = {}
+        for n in range(50000):
+            desc = 'CARD {0} SHOP{1:05d} CITY'.format(n, n % 5000)
+            key = hashlib.md5(desc.encode('utf-8')).hexdigest()
+            values[key] = regex.match(desc).group(1).strip()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def benchmark(workdir, repeat):
+    """Return the best time of each phase over repeat runs, and the
+    calibration time of this machine."""
+    best = {}
+    calibration = calibrate()
+    for _ in range(repeat):
+        for phase, seconds in run_phases(workdir).items():
+            best[phase] = min(seconds, best.get(phase, seconds))
+        # calibrated along the runs, as the load of the machine changes
+        calibration = min(calibration, calibrate(2))
+    best['calibration'] = calibration
+    return best
+
+
+def compare(results, baseline, tolerance):
+    """Print results against baseline, return the phases now slower."""
+    slower = []
+    if 'calibration' in baseline:
+        # a baseline from a machine twice as fast expects twice less time
+        scale = results['calibration'] / baseline['calibration']
+        baseline = {phase: seconds * scale for phase, seconds in baseline.items()}
+    print('{0:<10} {1:>10} {2:>10} {3:>8}'.format('phase', 'seconds', 'baseline', 'ratio'))
+    for phase in PHASES:
+        seconds = results[phase]
+        if phase in baseline:
+            ratio = seconds / baseline[phase] if baseline[phase] else 1.0
+            print('{0:<10} {1:>10.4f} {2:>10.4f} {3:>8.2f}'.format(
+                phase, seconds, baseline[phase], ratio))
+            if ratio > 1 + tolerance:
+                slower.append(phase)
+        else:
+            print('{0:<10} {1:>10.4f} {2:>10} {3:>8}'.format(phase, seconds, '-', '-'))
+    return slower
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='small',
+                        help='preset sizes of the generated files (default: small)')
+    parser.add_argument('--rows', type=int, help='number of CSV rows')
+    parser.add_argument('--mappings', type=int, help='number of mappings')
+    parser.add_argument('--regex-ratio', type=float,
+                        help='ratio of regex mappings to all mappings')
+    parser.add_argument('--includes', type=int,
+                        help='number of files included by the journal')
+    parser.add_argument('--journal-rows', type=int,
+                        help='number of transactions in the journal')
+    parser.add_argument('--dupe-rate', type=float,
+                        help='ratio of CSV rows already in the journal')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the generator (default: 0)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs, the best one is kept (default: 3)')
+    parser.add_argument('--baseline', metavar='FILE', default=DEFAULT_BASELINE,
+                        help='baselines file (default: {0})'.format(DEFAULT_BASELINE))
+    parser.add_argument('--reference', metavar='FILE', default=DEFAULT_REFERENCE,
+                        help='reference baselines file, used without a baseline'
+                             ' (default: {0})'.format(DEFAULT_REFERENCE))
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as baseline of the scenario')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown ratio over baseline reported as a'
+                             ' regression (default: 0.2)')
+    return parser.parse_args()
+
+
+def run():
+    args = parse_args()
+    params = dict(SCENARIOS[args.scenario])
+    for name in params:
+        if getattr(args, name) is not None:
+            params[name] = getattr(args, name)
+    # a scenario with other sizes gets its own baseline
+    name = args.scenario
+    if params != SCENARIOS[args.scenario]:
+        name = ','.join('{0}={1}'.format(k, v) for k, v in sorted(params.items()))
+
+    with tempfile.TemporaryDirectory() as workdir:
+        generate(workdir, seed=args.seed, **params)
+        results = benchmark(workdir, args.repeat)
+
+    baselines = read_baselines(args.baseline)
+    advisory = name not in baselines
+    baseline = read_baselines(args.reference) if advisory else baselines
+
+    print('scenario {0}'.format(name))
+    if advisory and name in baseline:
+        print('no baseline saved on this machine, comparing to the reference')
+    slower = compare(results, baseline.get(name, {}), args.tolerance)
+    if args.save_baseline:
+        baselines[name] = results
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write('\n')
+    elif slower and advisory:
+        print('slower than reference: {0}'.format(', '.join(slower)),
+              file=sys.stderr)
+    elif slower:
+        print('slower than baseline: {0}'.format(', '.join(slower)),
+              file=sys.stderr)
+        sys.exit(1)
+
+
+def read_baselines(path):
+    """Return the baselines of each scenario kept in the file at path."""
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+if __name__ == '__main__':
+    run()
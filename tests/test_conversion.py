@@ -1,7 +1,23 @@
 import unittest
+import json
+import os
+import re
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+from datetime import date
 from io import StringIO
+from unittest import mock
 
-from icsv2ledger import main, parse_args_and_config_file, read_mapping_file
+import icsv2ledger
+
+from icsv2ledger import (CompletionIndex, JournalCache, MappingIndex, MappingInfo, main,
+                         parse_args_and_config_file, read_csv_records,
+                         read_csv_records_reversed, read_mapping_file,
+                         MappingProfile, RunStats, load_stage_hooks, run_sections, scan_journal, compact_mapping_file, MappingWriter,
+                         TransferFiles, VocabularyCache, csv_md5sum_from_ledger, journal_files, ConversionHandler, ConversionService, run_client)
 
 
 class TestLocationService(unittest.TestCase):
@@ -69,6 +85,583 @@ class TestLocationService(unittest.TestCase):
 """
         )
 
+    def test_skip_older_than(self):
+        infile = open('stubs/transfer.csv')
+        out = StringIO()
+
+        args = parse_args_and_config_file()
+        args.quiet = True
+        args.infile = infile
+        args.outfile = out
+        args.csv_date_format = "%d/%m/%Y"
+        args.skip_lines = 0
+        args.debit = 0
+        args.delimiter = ';'
+        args.csv_decimal_comma = True
+        args.mapping_file = 'stubs/transfer_mapping.txt'
+        args.skip_older_than = (date.today() - date(2019, 3, 17)).days
+        main(args)
+
+        infile.close()
+
+        self.assertEqual(
+            [line for line in out.getvalue().splitlines() if 'CSV:' in line],
+            ["    ; CSV: 17/03/2019;TRANSFER SENT SAVINGS ACC;;-100,00;EUR",
+             "    ; CSV: 17/03/2019;TRANSFER SENT SAVINGS ACC;;-100,00;EUR",
+             "    ; CSV: 17/03/2019;CREDIT CARD 17/12/2018 MY RESTAURANT;;-80,50;EUR"])
+
+    def test_unknown_template_field(self):
+        infile = open('stubs/simple.csv')
+        out = StringIO()
+
+        args = parse_args_and_config_file()
+        args.quiet = True
+        args.infile = infile
+        args.outfile = out
+        args.csv_date_format = "%d/%m/%Y"
+        args.skip_lines = 0
+        args.delimiter = ';'
+        args.mapping_file = 'stubs/simple_mapping.txt'
+        args.template_file = 'stubs/bad_template.txt'
+        with self.assertRaises(SystemExit):
+            main(args)
+
+        infile.close()
+
+        self.assertEqual(out.getvalue(), "")
+
+    def test_read_csv_records_multiline(self):
+        infile = StringIO('Date,Desc,Amount\r\n'
+                          '01/02/2019,"TWO\r\nLINES",1.00\r\n'
+                          '02/02/2019,ONE LINE,2.00\r\n')
+
+        records = list(read_csv_records(infile, 1, ','))
+
+        self.assertEqual(records, [
+            (['01/02/2019', 'TWO\r\nLINES', '1.00'],
+             '01/02/2019,"TWO\r\nLINES",1.00\r\n'),
+            (['02/02/2019', 'ONE LINE', '2.00'],
+             '02/02/2019,ONE LINE,2.00\r\n')])
+
+    def test_multiline_record(self):
+        infile = StringIO('2020-01-01,"Shop\nline2",10.00\n')
+        infile.name = 'multiline.csv'
+        out = StringIO()
+
+        args = parse_args_and_config_file()
+        args.unattended = True
+        args.infile = infile
+        args.outfile = out
+        args.csv_date_format = "%Y-%m-%d"
+        args.skip_lines = 0
+        args.mapping_file = 'stubs/simple_mapping.txt'
+        main(args)
+
+        self.assertEqual(
+            out.getvalue(), """2020-01-01 * Shop line2
+    ; MD5Sum: 7a41613acc85277000aff3f1e778d1b3
+    ; CSV: 2020-01-01,"Shop\\nline2",10.00
+    Expenses:Unknown                                                 10.00
+    Assets:Bank:Current
+
+"""
+        )
+
+    def test_read_csv_records_reversed(self):
+        text = ('Date,Desc,Amount\r\n' +
+                ''.join('0{0}/02/2019,"LINE\r\n{0}",{0}.00\r\n'.format(i)
+                        for i in range(1, 8)))
+        expected = list(reversed(list(read_csv_records(StringIO(text), 1, ','))))
+
+        for block_size in (1, 2, 3, 7, 1024):
+            records = read_csv_records_reversed(StringIO(text), 1, ',',
+                                                block_size)
+            self.assertEqual(list(records), expected)
+
+    def test_journal_cache_appended_file(self):
+        journal = ('15/03/2019 * My Restaurant\n'
+                   '    ; MD5Sum: ade6e00119fe2b145ecddb30e50e2d4c\n'
+                   '    ; CSV: 15/03/2019;MY RESTAURANT;;-92,90;EUR\n'
+                   '    Expenses:Dining\n'
+                   '    Assets:Bank:Current                  -92.90\n')
+        with tempfile.TemporaryDirectory() as tmp:
+            ledger_file = os.path.join(tmp, 'test.ledger')
+            cache_file = os.path.join(tmp, 'cache', 'journal.json')
+            with open(ledger_file, 'w') as f:
+                f.write(journal)
+            os.utime(ledger_file, (0, 0))
+
+            cache = JournalCache(cache_file)
+            found = cache.scan(ledger_file)
+            self.assertEqual(found['md5sums'], {'ade6e00119fe2b145ecddb30e50e2d4c'})
+            cache.save()
+
+            cache = JournalCache(cache_file)
+            cache.scan(ledger_file)
+            self.assertFalse(cache.modified)
+
+            with open(ledger_file, 'a') as f:
+                f.write('\n16/03/2019 * Other\n    ; MD5Sum: 0123\n    ; CSV: a;b')
+            found = cache.scan(ledger_file)
+            self.assertEqual(found['md5sums'], {'ade6e00119fe2b145ecddb30e50e2d4c', '0123'})
+            self.assertEqual(found['csv_comments'], {
+                '15/03/2019;MY RESTAURANT;;-92,90;EUR', 'a;b'})
+            cache.save()
+
+            with open(ledger_file, 'w') as f:
+                f.write(journal.replace('ade6', 'ffff'))
+            found = JournalCache(cache_file).scan(ledger_file)
+            self.assertEqual(found['md5sums'], {'ffffe00119fe2b145ecddb30e50e2d4c'})
+
+    def test_vocabulary_cache_glob_include(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ledger_file = os.path.join(tmp, 'main.ledger')
+            with open(ledger_file, 'w') as f:
+                f.write('include parts/*.ledger\n')
+            os.mkdir(os.path.join(tmp, 'parts'))
+            with open(os.path.join(tmp, 'parts', 'a.ledger'), 'w') as f:
+                f.write('account Expenses:A\n')
+            for path in (ledger_file, os.path.join(tmp, 'parts', 'a.ledger')):
+                os.utime(path, (0, 0))
+
+            cache = VocabularyCache(os.path.join(tmp, 'vocabulary.json'))
+            globs = {}
+            paths = [path for path, _ in journal_files(ledger_file, JournalCache(), globs)]
+            cache.put('ledger', time.time_ns(), paths, {'accounts': {'Expenses:A'}}, globs)
+            self.assertEqual(cache.get('ledger'), {'accounts': {'Expenses:A'}})
+
+            # a new file matched by the include is not in the cached values
+            with open(os.path.join(tmp, 'parts', 'b.ledger'), 'w') as f:
+                f.write('account Expenses:B\n')
+            self.assertIsNone(cache.get('ledger'))
+
+    def test_csv_md5sum_from_ledger_scans_once(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ledger_file = os.path.join(tmp, 'test.ledger')
+            # just written, as after an import, so not taken from the cache
+            with open(ledger_file, 'w') as f:
+                f.write('15/03/2019 * My Restaurant\n    ; MD5Sum: abc\n'
+                        '    Expenses:Dining\n    Assets:Bank:Current  -92.90\n')
+            with mock.patch('icsv2ledger._scan_journal_line',
+                            wraps=icsv2ledger._scan_journal_line) as scan_line:
+                csv_comments, md5sum_hashes = csv_md5sum_from_ledger(ledger_file, JournalCache())
+            self.assertEqual(md5sum_hashes, {'abc'})
+            self.assertEqual(scan_line.call_count, 4)
+
+    def test_csv_md5sum_from_ledger_without_vocabulary(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ledger_file = os.path.join(tmp, 'test.ledger')
+            with open(ledger_file, 'w') as f:
+                f.write('15/03/2019 * My Restaurant\n    ; MD5Sum: abc\n'
+                        '    Expenses:Dining\n    Assets:Bank:Current  -92.90\n')
+            cache = JournalCache()
+            csv_md5sum_from_ledger(ledger_file, cache)
+            self.assertEqual(cache.scan(ledger_file, vocabulary=False)['accounts'], set())
+            accounts, payees, _, md5sum_hashes = scan_journal(ledger_file, cache)
+            self.assertEqual(accounts, {'Expenses:Dining', 'Assets:Bank:Current'})
+            self.assertEqual(payees, {'My Restaurant'})
+            self.assertEqual(md5sum_hashes, {'abc'})
+
+    def test_scan_journal(self):
+        accounts, payees, csv_comments, md5sum_hashes = scan_journal('stubs/parsed_transfer.txt')
+
+        self.assertEqual(accounts, {'Expenses:Dining', 'Income:Unknown', 'Transfers:Savings',
+                                    'Assets:Bank:Current', 'Assets:Bank:Savings'})
+        self.assertEqual(payees, {'My Restaurant', 'Unknown Transfer', 'Savings'})
+        self.assertIn('16/03/2019;TRANSFER RECEIVED MR UNKNOWN;;250,73;EUR', csv_comments)
+        self.assertIn('2313495c75e0d4794c1f445d585f34c4', md5sum_hashes)
+
+    def test_completion_index(self):
+        values = ['Expenses:Food', 'Expenses:Food:Restaurant', 'Income:Salary',
+                  'Assets:Bank:Current', 'Assets:Bank:Savings']
+        index = CompletionIndex(values)
+
+        for text in ['', 'e', 'ex', 'exp', 'food', 'FOOD:R', 'bank:', 'bank:s', 'xyz', 'sa']:
+            self.assertEqual(index.complete(text),
+                             [v for v in values if text.upper() in v.upper()])
+
+        index.add('Expenses:Savings')
+        self.assertEqual(index.complete('sa'),
+                         ['Income:Salary', 'Assets:Bank:Savings', 'Expenses:Savings'])
+        self.assertIn('Expenses:Savings', index)
+        self.assertEqual(len(index), 6)
+
+    def test_atomic_output(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            out_path = os.path.join(tmp, 'out.ledger')
+            with open(out_path, 'w') as f:
+                f.write('old content\n')
+
+            for date_format, expected in (('%Y-%m-%d', 'old content'), ('%d/%m/%Y', 'My Restaurant')):
+                infile = open('stubs/simple.csv')
+                outfile = open(out_path, 'a')
+
+                args = parse_args_and_config_file()
+                args.quiet = True
+                args.atomic = True
+                args.output_buffer_size = 0
+                args.infile = infile
+                args.outfile = outfile
+                args.csv_date_format = date_format
+                args.skip_lines = 0
+                args.debit = 0
+                args.delimiter = ';'
+                args.csv_decimal_comma = True
+                args.mapping_file = 'stubs/simple_mapping.txt'
+                if expected == 'old content':
+                    with self.assertRaises(ValueError):
+                        main(args)
+                else:
+                    main(args)
+
+                infile.close()
+                outfile.close()
+
+                with open(out_path) as f:
+                    self.assertIn(expected, f.read())
+                self.assertEqual(os.listdir(tmp), ['out.ledger'])
+
+    def test_transfer_files(self):
+        abc, ghi, def_ = 'a' * 32, 'c' * 32, 'd' * 32
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'savings.dat')
+            with open(path, 'w') as f:
+                f.write('2018/12/10 * Bob\n    ; MD5Sum: ' + abc + '\n')
+                # written by a template without the MD5Sum comment
+                f.write('2018/12/10 * Carol ; id: ' + ghi + '\n')
+
+            with TransferFiles() as transfer_files:
+                self.assertTrue(transfer_files.contains(path, abc))
+                self.assertTrue(transfer_files.contains(path, ghi))
+                self.assertFalse(transfer_files.contains(path, def_))
+                transfer_files.write(path, def_, '2018/12/11 * Alice\n    ; MD5Sum: ' + def_ + '\n')
+                self.assertTrue(transfer_files.contains(path, def_))
+
+            with TransferFiles() as transfer_files:
+                self.assertTrue(transfer_files.contains(path, def_))
+            with open(path) as f:
+                self.assertEqual(f.read().count('MD5Sum'), 2)
+
+    def test_mapping_writer(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            map_file = os.path.join(tmp, 'mapping.txt')
+            with open('stubs/simple_mapping.txt') as f, open(map_file, 'w') as out:
+                out.write(f.read().rstrip('\n'))
+            count = len(read_mapping_file(map_file))
+
+            with MappingWriter(map_file, flush_interval=60) as writer:
+                writer.append('MY SHOP', 'Shop', 'Expenses:Shopping', [])
+                self.assertEqual(len(read_mapping_file(map_file)), count)
+                writer.append('MY SHOP', 'My Shop', 'Expenses:Food', ['tag1'])
+            mappings = read_mapping_file(map_file)
+            self.assertEqual(len(mappings), count + 2)
+
+            self.assertEqual(compact_mapping_file(map_file), 1)
+            compacted = read_mapping_file(map_file)
+            self.assertEqual(compacted, mappings[:-2] + mappings[-1:])
+            self.assertEqual(compact_mapping_file(map_file), 0)
+
+    def test_batch(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open('stubs/simple.csv') as f:
+                content = f.read()
+            for name in ('a.csv', 'b.csv'):
+                with open(os.path.join(tmp, name), 'w') as f:
+                    f.write(content)
+
+            outputs = []
+            for jobs in (1, 2):
+                args = parse_args_and_config_file()
+                args.quiet = True
+                args.skip_dupes = True
+                args.batch = [os.path.join(tmp, '*.csv')]
+                args.output_dir = os.path.join(tmp, str(jobs))
+                args.jobs = jobs
+                args.csv_date_format = "%d/%m/%Y"
+                args.skip_lines = 0
+                args.debit = 0
+                args.delimiter = ';'
+                args.csv_decimal_comma = True
+                args.mapping_file = 'stubs/simple_mapping.txt'
+                os.mkdir(args.output_dir)
+                main(args)
+
+                with open(os.path.join(args.output_dir, 'a.ledger')) as f:
+                    a = f.read()
+                with open(os.path.join(args.output_dir, 'b.ledger')) as f:
+                    b = f.read()
+                outputs.append((a, b))
+
+            self.assertIn('MD5Sum: ade6e00119fe2b145ecddb30e50e2d4c', outputs[0][0])
+            # b.csv only holds transactions already converted from a.csv
+            self.assertEqual(outputs[0][1], '')
+            self.assertEqual(outputs[0], outputs[1])
+
+    def test_run_sections(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            with open('stubs/simple.csv') as f:
+                content = f.read()
+            for name in ('a', 'b'):
+                os.mkdir(os.path.join(tmp, name))
+                with open(os.path.join(tmp, name, 'export.csv'), 'w') as f:
+                    f.write(content)
+            config_file = os.path.join(tmp, 'config')
+            with open(config_file, 'w') as f:
+                for name in ('A', 'B'):
+                    f.write('[{0}]\n'.format(name))
+                    f.write('input_files={0}/*.csv\n'.format(os.path.join(tmp, name.lower())))
+                    f.write('quiet=True\nskip_dupes=True\njobs=1\n'
+                            'csv_date_format=%d/%m/%Y\nskip_lines=0\ndebit=0\n'
+                            'delimiter=;\ncsv_decimal_comma=True\n'
+                            'mapping_file=stubs/simple_mapping.txt\n')
+                    f.write('account=Assets:Bank:{0}\n'.format(name))
+                f.write('[C]\naccount=Assets:Bank:C\n')
+
+            args = parse_args_and_config_file()
+            args.config_file = config_file
+            args.sections = []
+            run_sections(args)
+
+            with open(os.path.join(tmp, 'a', 'export.ledger')) as f:
+                self.assertIn('Assets:Bank:A', f.read())
+            # transactions of B differ by their account, and are not duplicates
+            with open(os.path.join(tmp, 'b', 'export.ledger')) as f:
+                self.assertIn('Assets:Bank:B', f.read())
+
+    def test_quiet_pipeline(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            in_path = os.path.join(tmp, 'in.csv')
+            with open(in_path, 'w') as f:
+                for day in range(1, 29):
+                    f.write('{0:02}/03/2019;CREDIT CARD 15/12/2018 MY RESTAURANT;;-{0},90;EUR\n'.format(day))
+                    f.write('{0:02}/03/2019;TRANSFER RECEIVED MR UNKNOWN;;250,73;EUR\n'.format(day))
+                # a duplicate, skipped across chunks
+                f.write('01/03/2019;CREDIT CARD 15/12/2018 MY RESTAURANT;;-1,90;EUR\n')
+
+            outputs = []
+            for jobs in (1, 2):
+                infile = open(in_path, newline='')
+                out = StringIO()
+
+                args = parse_args_and_config_file()
+                args.quiet = True
+                args.skip_dupes = True
+                args.jobs = jobs
+                args.infile = infile
+                args.outfile = out
+                args.csv_date_format = "%d/%m/%Y"
+                args.skip_lines = 0
+                args.debit = 0
+                args.delimiter = ';'
+                args.csv_decimal_comma = True
+                args.mapping_file = 'stubs/simple_mapping.txt'
+                with mock.patch('icsv2ledger.PIPELINE_CHUNK_SIZE', 5):
+                    main(args)
+                infile.close()
+                outputs.append(out.getvalue())
+
+            self.assertEqual(outputs[0].count('MD5Sum'), 56)
+            self.assertEqual(outputs[0], outputs[1])
+
+    def test_flush_before_prompt(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            in_path = os.path.join(tmp, 'in.csv')
+            with open(in_path, 'w') as f:
+                f.write('01/03/2019;CREDIT CARD 15/12/2018 MY RESTAURANT;;-1,90;EUR\n')
+                f.write('02/03/2019;NEW SHOP;;-2,90;EUR\n')
+                f.write('03/03/2019;OTHER SHOP;;-3,90;EUR\n')
+            map_file = os.path.join(tmp, 'mapping.txt')
+            shutil.copy('stubs/simple_mapping.txt', map_file)
+            out = StringIO()
+            prompted = []
+
+            def prompt(prompt, values, default):
+                with open(map_file) as f:
+                    prompted.append((out.getvalue().count('MD5Sum'), 'NEW SHOP' in f.read()))
+                return ''
+
+            args = parse_args_and_config_file()
+            args.quiet = True
+            args.infile = open(in_path, newline='')
+            args.outfile = out
+            args.csv_date_format = "%d/%m/%Y"
+            args.skip_lines = 0
+            args.debit = 0
+            args.delimiter = ';'
+            args.csv_decimal_comma = True
+            args.mapping_file = map_file
+            args.flush_interval = 3600
+            args.mapping_flush_interval = 3600
+            with mock.patch('icsv2ledger.prompt_for_value', prompt), \
+                    mock.patch('sys.stdout', StringIO()):
+                main(args)
+            args.infile.close()
+
+            # payee and account prompts of each new shop
+            self.assertEqual(prompted, [(1, False), (1, False), (2, True), (2, True)])
+            self.assertEqual(out.getvalue().count('MD5Sum'), 3)
+
+    def test_server(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            map_file = os.path.join(tmp, 'mapping.txt')
+            shutil.copy('stubs/simple_mapping.txt', map_file)
+            socket_path = os.path.join(tmp, 'socket')
+
+            args = parse_args_and_config_file()
+            args.csv_date_format = "%d/%m/%Y"
+            args.skip_lines = 0
+            args.debit = 0
+            args.delimiter = ';'
+            args.csv_decimal_comma = True
+            args.mapping_file = map_file
+            server = socketserver.UnixStreamServer(socket_path, ConversionHandler)
+            server.service = ConversionService(args)
+            # no process pool nor mapping file rewrite for each request
+            options = server.service.section_options()
+            self.assertEqual((options.jobs, options.compact_mappings, options.stats),
+                             (1, False, False))
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+
+            def convert(csv):
+                args.client = socket_path
+                args.infile = StringIO(csv)
+                args.outfile = StringIO()
+                run_client(args)
+                return args.outfile.getvalue()
+
+            try:
+                with open('stubs/simple.csv') as f:
+                    self.assertIn('Expenses:Dining', convert(f.read()))
+                # unmapped entries are not asked for, nor learned
+                row = '17/03/2019;NEW SHOP;;-5,00;EUR\n'
+                self.assertIn('Expenses:Unknown', convert(row))
+                with open(map_file) as f:
+                    self.assertNotIn('NEW SHOP', f.read())
+                # changed mappings are read again
+                with open(map_file, 'a') as f:
+                    f.write('\nNEW SHOP,New Shop,Expenses:Shopping\n')
+                self.assertIn('Expenses:Shopping', convert(row))
+                with self.assertRaises(SystemExit):
+                    convert('not a date;x;;1;EUR\n')
+                # conversion options of the client would be ignored
+                with mock.patch('sys.argv', ['icsv2ledger.py', '--client', socket_path,
+                                             '--skip-lines', '1']), \
+                        mock.patch('sys.stderr', StringIO()) as stderr, \
+                        self.assertRaises(SystemExit):
+                    parse_args_and_config_file()
+                self.assertIn('--skip-lines', stderr.getvalue())
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+    def test_conversion_service_glob_include(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.mkdir(os.path.join(tmp, 'parts'))
+            ledger_file = os.path.join(tmp, 'main.ledger')
+            with open(ledger_file, 'w') as f:
+                f.write('include parts/*.ledger\n')
+            with open(os.path.join(tmp, 'parts', 'a.ledger'), 'w') as f:
+                f.write('account Assets:Bank:Current\n')
+
+            args = parse_args_and_config_file()
+            args.csv_date_format = "%d/%m/%Y"
+            args.skip_lines = 0
+            args.debit = 0
+            args.delimiter = ';'
+            args.csv_decimal_comma = True
+            args.mapping_file = 'stubs/simple_mapping.txt'
+            args.ledger_file = ledger_file
+            args.native_scanner = True
+            args.skip_dupes = True
+            service = ConversionService(args)
+            with open('stubs/simple.csv') as f:
+                request = {'csv': f.read()}
+
+            ledger = service.convert(request)['ledger']
+            self.assertIn('MD5Sum', ledger)
+            # a new file matching the include pattern holds the rows
+            with open(os.path.join(tmp, 'parts', 'b.ledger'), 'w') as f:
+                f.write(ledger)
+            self.assertNotIn('MD5Sum', service.convert(request)['ledger'])
+
+    def test_stats_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            infile = open('stubs/simple.csv')
+
+            args = parse_args_and_config_file()
+            args.quiet = True
+            args.skip_dupes = True
+            args.infile = infile
+            args.outfile = StringIO()
+            args.stats_file = os.path.join(tmp, 'stats.json')
+            args.ledger_file = 'stubs/parsed_transfer.txt'
+            args.csv_date_format = "%d/%m/%Y"
+            args.skip_lines = 0
+            args.debit = 0
+            args.delimiter = ';'
+            args.csv_decimal_comma = True
+            args.mapping_file = 'stubs/simple_mapping.txt'
+            main(args)
+            infile.close()
+
+            with open(args.stats_file) as f:
+                report = json.load(f)
+            self.assertEqual(report['rows']['read'], 2)
+            self.assertEqual(report['rows']['duplicates'] + report['rows']['converted'], 2)
+            self.assertEqual(report['mappings']['hits'], report['rows']['converted'])
+            self.assertIn('startup', report['phases'])
+
+            # without --stats, rows are neither timed nor counted
+            stats = RunStats(enabled=False)
+            args.stats_file = ''
+            args.infile = open('stubs/simple.csv')
+            main(args, stats=stats)
+            args.infile.close()
+            self.assertEqual((dict(stats.phases), dict(stats.counts)), ({}, {}))
+
+    def test_mapping_profile(self):
+        index = MappingIndex([
+            MappingInfo('SHOP', 'Shop', 'Expenses:Old', [], None, None),
+            MappingInfo(re.compile('SHOP'), 'Shops', 'Expenses:Shops', [], None, None),
+            MappingInfo('SHOP', 'Shop', 'Expenses:Shop', [], None, None),
+            MappingInfo('NEVER', 'Never', 'Expenses:Never', [], None, None)])
+        profile = MappingProfile(index)
+        for desc in ('SHOP', 'SHOP 42', 'OTHER'):
+            profile.record(desc)
+
+        rules = profile.rules()
+        self.assertEqual([(rule['hits'], rule['shadowed']) for rule in rules],
+                         [(0, 1), (1, 1), (1, 0), (0, 0)])
+        self.assertEqual(rules[1]['pattern'], '/SHOP/')
+
+    def test_stage_hooks(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            hook_file = os.path.join(tmp, 'hooks.py')
+            with open(hook_file, 'w') as f:
+                f.write('def on_stage(stage, seconds):\n    pass\n')
+            hooks = load_stage_hooks([hook_file + ':on_stage'])
+            self.assertEqual([hook.__name__ for hook in hooks], ['on_stage'])
+
+        stages = []
+        infile = open('stubs/simple.csv')
+        args = parse_args_and_config_file()
+        args.quiet = True
+        args.infile = infile
+        args.outfile = StringIO()
+        args.csv_date_format = "%d/%m/%Y"
+        args.skip_lines = 0
+        args.debit = 0
+        args.delimiter = ';'
+        args.csv_decimal_comma = True
+        args.mapping_file = 'stubs/simple_mapping.txt'
+        main(args, stats=RunStats(hooks=[lambda stage, seconds: stages.append(stage)]))
+        infile.close()
+
+        self.assertEqual(stages.count('render'), 2)
+        self.assertTrue({'startup', 'read', 'parse', 'match', 'dedupe', 'write'} <= set(stages))
+
     def test_tag_mapping(self):
         result = read_mapping_file('stubs/tag_mapping.txt')
 
@@ -90,6 +683,25 @@ class TestLocationService(unittest.TestCase):
         self.assertEqual(result[2].transfer_to, "Assets:Bank:Savings")
         self.assertEqual(result[2].transfer_to_file, "savings.dat")
 
+    def test_mapping_index_last_mapping_wins(self):
+        index = MappingIndex(read_mapping_file('stubs/transfer_mapping.txt'))
+        index.append(MappingInfo(re.compile('.*RESTAURANT'), 'Food', 'Expenses:Food', [], None, None))
+        index.append(MappingInfo(re.compile('(.*) 17/12/2018'), r'\1', 'Expenses:Card', [], None, None))
+
+        mapping, match = index.lookup('CREDIT CARD 15/12/2018 MY RESTAURANT')
+        self.assertEqual(mapping.payee, 'Food')
+        mapping, match = index.lookup('CREDIT CARD 17/12/2018 MY RESTAURANT')
+        self.assertEqual(mapping.account, 'Expenses:Card')
+        self.assertEqual(match.groups(), ('CREDIT CARD',))
+        mapping, match = index.lookup('TRANSFER RECEIVED MR UNKNOWN')
+        self.assertEqual(mapping.payee, 'Unknown Transfer')
+        self.assertIsNone(match)
+
+        index.append(MappingInfo('TRANSFER RECEIVED MR UNKNOWN', 'Mr Unknown', 'Income:Gifts', [], None, None))
+        mapping, match = index.lookup('TRANSFER RECEIVED MR UNKNOWN')
+        self.assertEqual(mapping.payee, 'Mr Unknown')
+        self.assertEqual(index.lookup('NOTHING MATCHES'), (None, None))
+
     def test_transfer_parsing(self):
         infile = open('stubs/transfer.csv')
         out = StringIO()